@@ -12,42 +12,54 @@ Authors:
     Daan Lichtenberg
 
 Purpose:
-    The following function executes the entire project created during the course 
+    The following function executes the entire project created during the course
     Geo-Information and Remote Sensing Integration at Wageningen University & Research.
-    
 
-    
-    
+    Every script is declared as a stage with its input and output files. A stage is only
+    executed again when its outputs are missing or when its inputs (including the script itself)
+    changed since its last successful run. Stages that do not depend on each other
+    (e.g. the VV and VH clipping, or s03 and s04a) are executed concurrently.
+
 """
 
 import subprocess
 import os
-import geopandas as gpd
-
-# Import individual scripts
+import sys
+import glob
+import json
+import argparse
+import importlib
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # Define individual directories
-data_dir = "data/"
-output_dir = "output/"
+# The project folder is used as absolute path, since the working directory changes when running in process
+project_dir = os.path.dirname(os.path.abspath(__file__))
+data_dir = os.path.join(project_dir, "data/")
+output_dir = os.path.join(project_dir, "output/")
+scripts_dir = os.path.join(project_dir, "scripts/")
+
+# File recording the input fingerprints of every successfully executed stage
+state_fp = os.path.join(output_dir, ".pipeline_state.json")
 
 
 # Define script paths
 def run_script(script_name, script_args=None):
     # First join the script filepath together
     # script_fp = os.path.join("scripts/", script_name)
-    
+
     # Prepare the command to run the script
     command = ["python", script_name]
 
     # If there are any arguments, add them to the command
     if script_args:
         command.extend(script_args)
-    
+
     print(f"Running script: '{script_name}'\n")
 
-    # Run the script and capture the output in real-time
-    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, cwd="scripts/")
-    
+    # Run the script and capture the output
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, cwd=scripts_dir)
+
     # Print the script's output
     print(process.stdout)
 
@@ -57,49 +69,271 @@ def run_script(script_name, script_args=None):
         print(process.stderr)
     print("\n")
 
-    
-
-"""
-Script #1: Filtering and joining of BRP & ANLB data
-"""
-# Run the script and capture the output
-run_script("s01_preprocess_vector_data.py")
-
-"""
-Script #2: Filtering and clipping of Sentinel-1 images
-"""
-
-run_script("s02_preprocess_raster_data.py")
-
-""" Script #3
-This script does the following:
-    1. Extract SAR backscatter on ANLB + BRP parcels throughout the whole year from central overpass
-    2. Get statistics of both vector datasets as: min, mean, median, max and saves it as .csv
-    3. Repeat for five representative pixels which are inundated in 2021
-    4. Create and save this as time-series figure
-
-Comments:
-    - Ideally this script is ONLY used when more information on the problem is required as it takes >2 hours to run
-    - Output is not used in the rest of the model pipeline
-
-"""
-
-run_script("s03_get_anlb_statistics_from_sar.py")
-
-run_script("s04a_threshold_image_average.py")
-
-
-run_script("s04c_thresholding.py", ["--threshold_value=0.7"])
-
-run_script("s04d_validation.py", ["--threshold_value=0.7"])
-
-run_script("s05a_visualisation_preprocessing.py")
-
-run_script("s05b_visualisation_demo.py")
-
-
-
+    return process.returncode
 
 
+def run_in_process(script_name, kwargs, datasets):
+    """
+    Run the main() function of a script in the current process. Loaded datasets are shared with the
+    other stages through 'datasets' (see scripts/shared_datasets.py), so inputs are only read from disk once.
+    """
+    print(f"Running script in process: '{script_name}'\n")
 
+    try:
+        module = importlib.import_module(os.path.splitext(script_name)[0])
+        module.main(datasets=datasets, **kwargs)
+    # A script calling sys.exit() must only fail its own stage, not end the whole pipeline
+    except (Exception, SystemExit):
+        print("Error:")
+        traceback.print_exc()
+        return 1
 
+    print("\n")
+    return 0
+
+
+def stage(name, script_name, inputs, outputs, script_args=None, kwargs=None):
+    """
+    Declare a single pipeline stage.
+
+    Parameters
+    ----------
+    name : string
+        Unique name of the stage.
+    script_name : string
+        Script in the scripts/ folder executed by the stage.
+    inputs : list of strings
+        Glob patterns (relative to the project folder) of the files read by the stage, including the
+        helper modules imported by the script (the script itself is added automatically).
+        A stage of which a helper module changed is executed again.
+    outputs : list of strings
+        Glob patterns (relative to the project folder) of the files written by the stage.
+        Stages without outputs are always executed.
+    script_args : list of strings
+        Command line arguments passed to the script.
+    kwargs : dict
+        Keyword arguments passed to the main() function of the script, equal to script_args
+        but used when the stage is executed in process.
+
+    Returns
+    -------
+    dict
+        The stage declaration.
+
+    """
+    return {"name": name, "script": script_name, "args": script_args or [], "kwargs": kwargs or {},
+            "inputs": [os.path.join("scripts", script_name)] + inputs, "outputs": outputs}
+
+
+def fingerprint(st):
+    """
+    Fingerprint the inputs of a stage as the modification time and size of every matching file,
+    together with the command line arguments of the stage.
+    """
+    files = {}
+    for pattern in st["inputs"]:
+        for fp in sorted(glob.glob(os.path.join(project_dir, pattern), recursive=True)):
+            file_stat = os.stat(fp)
+            files[os.path.relpath(fp, project_dir).replace(os.sep, "/")] = [file_stat.st_mtime_ns, file_stat.st_size]
+
+    return {"args": st["args"], "files": files}
+
+
+def is_fresh(st, state):
+    """
+    A stage is fresh when all of its outputs exist and its inputs did not change since the last run.
+    """
+    if not st["outputs"]:
+        return False
+
+    if any(not glob.glob(os.path.join(project_dir, pattern), recursive=True) for pattern in st["outputs"]):
+        return False
+
+    return state.get(st["name"]) == fingerprint(st)
+
+
+def dependencies(stages):
+    """
+    A stage depends on every earlier stage which writes one of its input patterns.
+    """
+    deps = {}
+    for i, st in enumerate(stages):
+        deps[st["name"]] = {other["name"] for other in stages[:i]
+                            if set(other["outputs"]) & set(st["inputs"])}
+    return deps
+
+
+def run_pipeline(stages, max_workers=2, force=False, in_process=False):
+    """
+    Execute the stages in dependency order. Stages of which all dependencies finished are started
+    concurrently (up to max_workers at the same time), fresh stages are skipped.
+
+    With in_process, the stages are executed in the current process instead of one Python process per script,
+    which avoids the import overhead and shares the loaded datasets between the stages. The stages then share
+    the datasets and the module level caches of the scripts (and s03 plots with pyplot), so they are executed
+    one by one in the main thread instead of concurrently.
+    """
+    if in_process:
+        # The scripts use paths relative to the scripts folder and import each other
+        os.chdir(scripts_dir)
+        sys.path.insert(0, scripts_dir)
+
+    # Datasets shared between the stages when running in process
+    datasets = {}
+
+    state = {}
+    if os.path.exists(state_fp):
+        with open(state_fp) as f:
+            state = json.load(f)
+
+    deps = dependencies(stages)
+    pending = list(stages)
+    finished, failed = set(), set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for st in list(pending):
+                # Skip stages of which a dependency failed
+                if deps[st["name"]] & failed:
+                    print(f"Skipping '{st['name']}' because a stage it depends on failed\n")
+                    failed.add(st["name"])
+                    pending.remove(st)
+
+                elif deps[st["name"]] <= finished:
+                    pending.remove(st)
+
+                    if not force and is_fresh(st, state):
+                        print(f"Stage '{st['name']}' is up to date\n")
+                        finished.add(st["name"])
+                    else:
+                        # Fingerprint the inputs before the run, so changes during the run trigger a rerun next time
+                        st_fingerprint = fingerprint(st)
+                        if in_process:
+                            # Executed right away in the main thread, the result is handled like any other stage
+                            future = Future()
+                            future.set_result(run_in_process(st["script"], st["kwargs"], datasets))
+                        else:
+                            future = executor.submit(run_script, st["script"], st["args"])
+                        running[future] = (st, st_fingerprint)
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                st, st_fingerprint = running.pop(future)
+
+                if future.result() == 0:
+                    finished.add(st["name"])
+                    state[st["name"]] = st_fingerprint
+
+                    os.makedirs(output_dir, exist_ok=True)
+                    with open(state_fp, "w") as f:
+                        json.dump(state, f, indent=2)
+                else:
+                    print(f"Stage '{st['name']}' failed\n")
+                    failed.add(st["name"])
+
+
+if __name__ == "__main__":
+    # Create the parser
+    parser = argparse.ArgumentParser(description='Puddles pipeline')
+    parser.add_argument('--threshold_value', type=float, default=0.7, help='Threshold value passed to s04c and s04d. Defaults to 0.7')
+    parser.add_argument('--workers', type=int, default=2, help='Maximum number of stages executed at the same time. Defaults to 2')
+    parser.add_argument('--force', action='store_true', help='Execute all stages, also when their outputs are up to date')
+    parser.add_argument('--in_process', action='store_true', help='Execute the stages one by one in this process and share the loaded datasets between them')
+    args = parser.parse_args()
+
+    threshold_args = [f"--threshold_value={args.threshold_value}"]
+    threshold_kwargs = {"threshold_value": args.threshold_value}
+
+    # Files shared between the stages
+    anlb_filtered = ["data/01_ANLB_filtered.*"]
+    subsidised_field = ["output/01_subsidised_field.*"]
+    brp_sample = ["output/01_brp_grassland_sample_1000.*"]
+    drygrass_merged = ["output/01_anlb_drygrass_merged.*"]
+    averages = ["data/thresholding_data/output/averages/*.tif"]
+    water_polygons = ["data/training_data/Water*.*"]
+    threshold_cache = ["output/04b_threshold_cache.json"]
+
+    # Helper modules imported by the scripts
+    vector_helpers = ["scripts/vector_cache.py", "scripts/shared_datasets.py"]
+    label_helpers = ["scripts/parcel_pixel_store.py", "scripts/parcel_labels.py"]
+    s04b = ["scripts/s04b_get_threshold_value.py"] + vector_helpers
+
+
+    stages = []
+
+    """
+    Script #1: Filtering and joining of BRP & ANLB data
+    """
+    stages.append(stage("s01", "s01_preprocess_vector_data.py",
+                        inputs=vector_helpers + ["data/Shapes/gewaspercelen_2021_S2Tiles_GWT_BF12_AHN2.*", "data/Shapes/ANLB_2021.*"],
+                        outputs=anlb_filtered + ["data/01_brp_grasslands.*"] + subsidised_field + brp_sample + drygrass_merged))
+
+    """
+    Script #2: Filtering and clipping of Sentinel-1 images
+    The VV and VH polarisations are independent of each other and run concurrently
+    """
+    for polarisation in ["VV", "VH"]:
+        stages.append(stage(f"s02_{polarisation}", "s02_preprocess_raster_data.py",
+                            inputs=vector_helpers + label_helpers + ["scripts/sar_cube.py", "scripts/raster_io.py"]
+                                   + drygrass_merged + [f"data/S1_{polarisation}_filtered/*.tif"],
+                            outputs=[f"output/02_{polarisation}_mp_clipped/*.tif", f"output/02_{polarisation}_parcel_pixels/*",
+                                     f"data/thresholding_data/training/{polarisation.lower()}sar/*.tif"],
+                            script_args=["--polarisation", polarisation], kwargs={"polarisations": [polarisation]}))
+
+    """
+    Script #2b: Stack the clipped images of every polarisation into a dated time-series cube
+    s04c selects its date range and computes the running averages from the VH cube
+    """
+    stages.append(stage("s02b", "s02b_build_sar_cube.py",
+                        inputs=["scripts/sar_cube.py", "output/02_VV_mp_clipped/*.tif", "output/02_VH_mp_clipped/*.tif"],
+                        outputs=["output/02b_VV_cube.*", "output/02b_VH_cube.*"]))
+
+    """ Script #3
+    This script does the following:
+        1. Extract SAR backscatter on ANLB + BRP parcels throughout the whole year from central overpass
+        2. Get statistics of both vector datasets as: min, mean, median, max and saves it as .csv
+        3. Repeat for five representative pixels which are inundated in 2021
+        4. Create and save this as time-series figure
+
+    Comments:
+        - Ideally this script is ONLY used when more information on the problem is required as it takes >2 hours to run
+        - Output is not used in the rest of the model pipeline
+
+    """
+    stages.append(stage("s03", "s03_get_anlb_statistics_from_sar.py",
+                        inputs=vector_helpers + label_helpers + ["scripts/sar_cube.py"] + anlb_filtered + brp_sample + ["data/S1/*/Sigma0_dB_VH_*.tif"],
+                        outputs=["output/03_anlb_statistics.csv", "output/03_brp_statistics.csv", "output/03_timeseries_backscatter.png"]))
+
+    stages.append(stage("s04a", "s04a_threshold_image_average.py",
+                        inputs=["scripts/compositing.py", "scripts/raster_io.py", "data/thresholding_data/training/vhsar/*.tif"],
+                        outputs=averages))
+
+    # The thresholds are fitted once by s04b, s04c and s04d take them from its cache
+    stages.append(stage("s04b", "s04b_get_threshold_value.py",
+                        inputs=vector_helpers + brp_sample + averages + water_polygons,
+                        outputs=threshold_cache,
+                        script_args=threshold_args, kwargs=threshold_kwargs))
+
+    stages.append(stage("s04c", "s04c_thresholding.py",
+                        inputs=s04b + threshold_cache + label_helpers + ["scripts/compositing.py", "scripts/raster_io.py", "scripts/sar_cube.py"]
+                               + ["output/02b_VH_cube.*"] + subsidised_field + brp_sample + averages + water_polygons,
+                        outputs=[f"output/{args.threshold_value}-output.csv", f"output/{args.threshold_value}-parcel_inundation.csv"],
+                        script_args=threshold_args, kwargs=threshold_kwargs))
+
+    stages.append(stage("s04d", "s04d_validation.py",
+                        inputs=s04b + threshold_cache + ["scripts/raster_io.py"] + brp_sample + averages + water_polygons,
+                        outputs=[f"output/{args.threshold_value}-confusion_matrix.csv", f"output/{args.threshold_value}-confusion_matrix_per_image.csv"],
+                        script_args=threshold_args, kwargs=threshold_kwargs))
+
+    stages.append(stage("s05a", "s05a_visualisation_preprocessing.py",
+                        inputs=["data/visualisation/vh-results/0.5-*.csv", "data/visualisation/01_subsidised_field.*"],
+                        outputs=["data/visualisation/07_binary.csv", "data/visualisation/07_percent.csv", "data/visualisation/07_fields_subsidised.*"]))
+
+    run_pipeline(stages, max_workers=args.workers, force=args.force, in_process=args.in_process)
+
+    # The dashboard keeps running until it is stopped, therefore it is started after all other stages finished
+    run_script("s05b_visualisation_demo.py")
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Helper functions to composite a series of SAR images (or blocks or pixel arrays of them) over time.
+
+A composite reduces a window of consecutive images to a single image, e.g. the mean of two images:
+
+    window  : number of consecutive images reduced to one composite
+    stride  : number of images the window moves between composites, stride == window gives
+              non-overlapping composites (1+2, 3+4, ...), stride 1 a running composite (1+2, 2+3, ...)
+    reducer : 'mean', 'median' or 'min', all ignoring nodata (999) and NaN pixels. Pixels without any
+              valid value in the window are NaN in the composite
+
+The images are processed one by one. Every image is read once and kept only while it is in the window,
+the running mean is updated by adding the newest and subtracting the oldest image instead of summing
+the whole window again.
+"""
+import warnings
+from collections import deque
+
+import numpy as np
+
+REDUCERS = ("mean", "median", "min")
+
+
+def composite_ranges(n_images, window=2, stride=1, include_tail=False):
+    """
+    Function returns the (start, stop) positions of the images in every composite.
+
+    Parameters
+    ----------
+    n_images : int
+        Number of images.
+    window : int
+        Number of consecutive images per composite.
+    stride : int
+        Number of images the window moves between composites.
+    include_tail : bool
+        Add a composite of the last 'window' images when the last images are not part of any composite
+        (e.g. the last image of an odd number of images with window and stride 2).
+
+    Returns
+    -------
+    ranges : list of (start, stop) tuples.
+
+    """
+    ranges = [(start, start + window) for start in range(0, n_images - window + 1, stride)]
+    if include_tail and n_images >= window and ranges[-1][1] < n_images:
+        ranges.append((n_images - window, n_images))
+    return ranges
+
+
+def nodata_to_nan(image, nodata=999, out=None):
+    """
+    Function returns a floating point copy of the image with the nodata values set to NaN. The copy is
+    written to out if it has the right shape and dtype, e.g. the buffer of an image that left the window.
+    """
+    dtype = np.result_type(image.dtype, np.float32)
+    if out is None or out.shape != image.shape or out.dtype != dtype:
+        out = np.empty(image.shape, dtype=dtype)
+
+    np.copyto(out, image)
+    if nodata is not None:
+        out[out == nodata] = np.nan
+    return out
+
+
+def reduce_window(buffer, reducer, total=None, count=None, out=None):
+    """
+    Function reduces the images in the window (buffer) to a single composite, written to out if given.
+    """
+    if out is None:
+        out = np.empty_like(buffer[0])
+
+    if reducer == "mean":
+        # 0 / 0 gives NaN for pixels without any valid value
+        with np.errstate(invalid='ignore', divide='ignore'):
+            np.divide(total, count, out=out, casting='same_kind')
+
+    elif reducer == "min":
+        np.copyto(out, buffer[0])
+        for image in list(buffer)[1:]:
+            np.fmin(out, image, out=out)
+
+    else:
+        # All-NaN pixels are NaN in the composite, which is intended
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            out[...] = np.nanmedian(np.stack(buffer), axis=0)
+
+    return out
+
+
+def composites(images, window=2, stride=1, reducer="mean", nodata=999, include_tail=False, reuse_output=False):
+    """
+    Function composites a series of images, in the order of composite_ranges().
+
+    Parameters
+    ----------
+    images : iterable of numpy arrays
+        Images of the same shape in chronological order, e.g. a generator reading them (or a window of them)
+        one by one. Every image is only read once.
+    window : int
+        Number of consecutive images per composite.
+    stride : int
+        Number of images the window moves between composites.
+    reducer : string
+        'mean', 'median' or 'min'.
+    nodata : float
+        Nodata value of the images, ignored just like NaN. None only ignores NaN.
+    include_tail : bool
+        Add a composite of the last 'window' images when the last images are not part of any composite.
+    reuse_output : bool
+        Write every composite to the same array instead of a new one, so a composite is only valid until
+        the next one is requested.
+
+    Yields
+    ------
+    (start, stop) : tuple
+        Positions of the images in the composite.
+    composite : numpy array
+        Composite (floating point) of the images.
+
+    """
+    if reducer not in REDUCERS:
+        raise ValueError(f"Unknown reducer '{reducer}', choose from {', '.join(REDUCERS)}")
+    if window < 1 or stride < 1:
+        raise ValueError("window and stride should be at least 1")
+
+    buffer = deque()
+    total = count = composite = None
+    n_images = 0
+    last_stop = 0
+
+    for image in images:
+        # Drop the oldest image from a full window, its buffer is reused for the new image
+        oldest = None
+        if len(buffer) == window:
+            oldest = buffer.popleft()
+            if reducer == "mean":
+                valid = ~np.isnan(oldest)
+                np.subtract(total, oldest, out=total, where=valid)
+                count -= valid
+
+        image = nodata_to_nan(image, nodata, out=oldest)
+        buffer.append(image)
+        n_images += 1
+
+        if reducer == "mean":
+            # The running sum is kept in float64, so adding and subtracting images does not drift
+            if total is None:
+                total = np.zeros(image.shape, dtype='float64')
+                count = np.zeros(image.shape, dtype=np.min_scalar_type(window))
+            valid = ~np.isnan(image)
+            np.add(total, image, out=total, where=valid)
+            count += valid
+
+        if n_images >= window and (n_images - window) % stride == 0:
+            last_stop = n_images
+            composite = reduce_window(buffer, reducer, total, count, composite if reuse_output else None)
+            yield (n_images - window, n_images), composite
+
+    if include_tail and n_images >= window and last_stop < n_images:
+        composite = reduce_window(buffer, reducer, total, count, composite if reuse_output else None)
+        yield (n_images - window, n_images), composite
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Helper functions to burn polygons (parcels) into label grids, in which every pixel holds the position of its
+polygon (starting at 1) and 0 outside of all polygons.
+
+A single label grid can only hold one polygon per pixel, so where polygons overlap (or a polygon is
+duplicated) the last one would take the shared pixels. The polygons are therefore split into layers in which
+no two polygons overlap, and every layer is burned into its own label grid. Polygons that only touch each other
+share a layer. Most sets of parcels do not overlap at all and result in a single layer.
+
+For polygons spread over a large extent (e.g. parcels all over the Netherlands on a national scene), a label
+grid covering all of them is mostly empty. polygon_pixels() returns the pixels of every polygon as sparse
+(flat index, label) pairs instead, so its cost scales with the area of the polygons rather than their extent.
+"""
+import numpy as np
+import shapely
+import rasterio
+from rasterio.features import geometry_mask, rasterize
+
+
+def overlap_layers(geometries):
+    """
+    Function splits geometries into layers in which no two geometries overlap.
+
+    Parameters
+    ----------
+    geometries : array-like of shapely geometries
+        E.g. gdf.geometry.values.
+
+    Returns
+    -------
+    layers : list of numpy arrays with the positions of the geometries in every layer. Empty for no geometries.
+
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    if len(geometries) == 0:
+        return []
+
+    # Pairs of geometries sharing area, touching geometries do not share any pixel
+    left, right = shapely.STRtree(geometries).query(geometries, predicate='intersects')
+    pairs = left < right
+    left, right = left[pairs], right[pairs]
+    overlap = ~shapely.touches(geometries[left], geometries[right])
+    left, right = left[overlap], right[overlap]
+
+    # Greedily put every geometry in the first layer without any of the earlier geometries it overlaps
+    layer = np.zeros(len(geometries), dtype='int64')
+    order = np.argsort(right, kind='stable')
+    left, right = left[order], right[order]
+    starts = np.searchsorted(right, np.unique(right))
+    for position, earlier in zip(np.unique(right), np.split(left, starts[1:])):
+        used = set(layer[earlier].tolist())
+        layer[position] = next(k for k in range(len(used) + 1) if k not in used)
+
+    return [np.flatnonzero(layer == k) for k in range(layer.max() + 1)]
+
+
+def rasterize_layers(geometries, out_shape, transform, all_touched=False):
+    """
+    Function burns geometries into one label grid per overlap layer (see overlap_layers()).
+
+    Parameters
+    ----------
+    geometries : array-like of shapely geometries
+        Geometries in the coordinate system of the grid.
+    out_shape : tuple
+        (height, width) of the grid.
+    transform : Affine
+        Transform of the grid.
+    all_touched : bool
+        Label all pixels touched by a geometry, instead of only the pixels with their centre inside.
+
+    Returns
+    -------
+    label_layers : list of int32 label grids, together holding every pixel of every geometry.
+
+    """
+    geometries = np.asarray(geometries, dtype=object)
+
+    label_layers = []
+    for positions in overlap_layers(geometries):
+        shapes = ((geometries[position], int(position) + 1) for position in positions)
+        label_layers.append(rasterize(shapes, out_shape=out_shape, transform=transform, fill=0,
+                                      all_touched=all_touched, dtype='int32'))
+    return label_layers
+
+
+def polygon_pixels(geometries, out_shape, transform, all_touched=False):
+    """
+    Function returns the pixels of every geometry as sparse (flat index, label) pairs. Every geometry is only
+    rasterized within its own bounding box, the same pixels as rasterizing all geometries on the full grid
+    (with all_touched, GDAL can label a few more corner pixels than when burning the full grid).
+
+    Parameters
+    ----------
+    geometries : array-like of shapely geometries
+        Geometries in the coordinate system of the grid.
+    out_shape : tuple
+        (height, width) of the grid.
+    transform : Affine
+        Transform of the grid.
+    all_touched : bool
+        Label all pixels touched by a geometry, instead of only the pixels with their centre inside.
+
+    Returns
+    -------
+    pixel_index : int64 numpy array with the flat index (row * width + col) of the pixels in the grid, sorted.
+    labels : int32 numpy array with the label (position of the geometry, starting at 1) of every pixel.
+        A pixel shared by overlapping geometries is listed once for every geometry.
+
+    """
+    height, width = out_shape
+    pixel_index = [np.zeros(0, dtype='int64')]
+    labels = [np.zeros(0, dtype='int32')]
+
+    for position, geom in enumerate(geometries):
+        if geom is None or geom.is_empty:
+            continue
+
+        # Window of the bounding box, one pixel wider on every side so touched pixels are never cut off
+        xmin, ymin, xmax, ymax = geom.bounds
+        cols, rows = ~transform * (np.array([xmin, xmax, xmin, xmax]), np.array([ymin, ymin, ymax, ymax]))
+        col_start, col_stop = max(int(np.floor(cols.min())) - 1, 0), min(int(np.ceil(cols.max())) + 1, width)
+        row_start, row_stop = max(int(np.floor(rows.min())) - 1, 0), min(int(np.ceil(rows.max())) + 1, height)
+        if col_stop <= col_start or row_stop <= row_start:
+            continue
+
+        inside = ~geometry_mask([geom], (row_stop - row_start, col_stop - col_start),
+                                transform * rasterio.Affine.translation(col_start, row_start), all_touched=all_touched)
+        inside_rows, inside_cols = np.nonzero(inside)
+
+        pixel_index.append((inside_rows + row_start).astype('int64') * width + inside_cols + col_start)
+        labels.append(np.full(len(inside_rows), position + 1, dtype='int32'))
+
+    pixel_index = np.concatenate(pixel_index)
+    labels = np.concatenate(labels)
+
+    order = np.argsort(pixel_index, kind='stable')
+    return pixel_index[order], labels[order]
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Helper functions for the parcel-pixel store, a compact alternative to the clipped GeoTIFFs written by s02.
+
+The clipped GeoTIFFs cover the bounding box of all parcels, of which almost every pixel is nodata (999).
+The store only contains the pixels of the parcels, so its size scales with the parcel area instead of the
+extent of the parcels. A store is a folder with the following files:
+
+    pixel_index.npy : int64 (n_pixels,) flat index (row * width + col) of every parcel pixel in the clipped grid
+    values.npy      : float32 (n_dates, n_pixels) backscatter of every pixel per date, the same values as the
+                      clipped GeoTIFFs (so 999 for nodata). Read as memory-mapped array
+    store.json      : dates, source filenames, clipped grid (crs, transform, width, height) and nodata value
+
+store.json is written last, a store without it is incomplete and is not read.
+
+The store does not record which parcel a pixel belongs to: neighbouring (or overlapping) parcels share pixels,
+and every script labels the pixels with its own parcels, see pixel_labels().
+"""
+import os
+import json
+
+import numpy as np
+import rasterio
+
+from parcel_labels import polygon_pixels
+
+
+def create_store(store_folder, pixel_index, n_dates):
+    """
+    Function creates a new (incomplete) store and returns the memory-mapped values array to fill.
+
+    Parameters
+    ----------
+    store_folder : string
+        Folder of the store, an existing store is replaced.
+    pixel_index : numpy array
+        Flat index of every parcel pixel in the clipped grid.
+    n_dates : int
+        Number of dates (scenes) stored.
+
+    Returns
+    -------
+    values : memory-mapped (n_dates, n_pixels) float32 array.
+
+    """
+    os.makedirs(store_folder, exist_ok=True)
+
+    # Remove the metadata first, so the store is incomplete until finish_store() is called
+    meta_fp = os.path.join(store_folder, "store.json")
+    if os.path.exists(meta_fp):
+        os.remove(meta_fp)
+
+    np.save(os.path.join(store_folder, "pixel_index.npy"), np.asarray(pixel_index, dtype='int64'))
+
+    return np.lib.format.open_memmap(os.path.join(store_folder, "values.npy"), mode='w+',
+                                     dtype='float32', shape=(n_dates, len(pixel_index)))
+
+
+def finish_store(store_folder, values, dates, filenames, crs, transform, width, height, nodata=999):
+    """
+    Function flushes the values and writes the metadata, which marks the store as complete.
+
+    Parameters
+    ----------
+    store_folder : string
+        Folder of the store.
+    values : memory-mapped array
+        Values array returned by create_store().
+    dates : list of strings
+        Date (YYYYMMDD) of every scene, in the order of the values.
+    filenames : list of strings
+        Source filename of every scene.
+    crs, transform, width, height :
+        Clipped grid the pixel index refers to.
+    nodata : float
+        Nodata value of the values.
+
+    Returns
+    -------
+    None.
+
+    """
+    values.flush()
+
+    meta = {"dates": list(dates), "filenames": list(filenames), "crs": str(crs),
+            "transform": list(transform)[:6], "width": int(width), "height": int(height), "nodata": nodata}
+
+    meta_fp = os.path.join(store_folder, "store.json")
+    with open(meta_fp + ".tmp", 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(meta_fp + ".tmp", meta_fp)
+
+
+def store_exists(store_folder):
+    return os.path.exists(os.path.join(store_folder, "store.json"))
+
+
+def open_store(store_folder):
+    """
+    Function opens a complete store.
+
+    Parameters
+    ----------
+    store_folder : string
+        Folder of the store.
+
+    Returns
+    -------
+    store : dictionary with the metadata of store.json, the 'transform' as Affine, and the arrays
+        'pixel_index' and 'values' (memory-mapped).
+
+    """
+    if not store_exists(store_folder):
+        raise FileNotFoundError(f"{store_folder} does not contain a complete parcel-pixel store. Please run script #2")
+
+    with open(os.path.join(store_folder, "store.json")) as f:
+        store = json.load(f)
+
+    store["transform"] = rasterio.Affine(*store["transform"])
+    store["pixel_index"] = np.load(os.path.join(store_folder, "pixel_index.npy"))
+    store["values"] = np.load(os.path.join(store_folder, "values.npy"), mmap_mode='r')
+    return store
+
+
+def pixel_labels(store, gdf, all_touched=False):
+    """
+    Function labels the pixels of the store with the geometries covering them. Only the pixels of every geometry
+    are looked up in the store (see polygon_pixels() in parcel_labels.py), so the cost scales with the area of
+    the geometries instead of the extent of the store.
+
+    Parameters
+    ----------
+    store : dictionary
+        Store opened with open_store().
+    gdf : GeoDataFrame
+        Geometries to label, in the coordinate system of the store.
+    all_touched : bool
+        Label all pixels touched by a geometry, instead of only the pixels with their centre inside.
+
+    Returns
+    -------
+    store_pixels : int64 numpy array with the position of the pixels in the store (index of the values), sorted.
+    labels : int32 numpy array with the label (position in gdf, starting at 1) of every pixel.
+        A pixel shared by overlapping geometries is listed once for every geometry.
+
+    """
+    pixel_index, labels = polygon_pixels(gdf.geometry.values, (store["height"], store["width"]), store["transform"], all_touched)
+
+    # Only keep the pixels of the geometries that are part of the store (the pixel index is sorted)
+    store_pixels = np.searchsorted(store["pixel_index"], pixel_index)
+    in_store = store_pixels < len(store["pixel_index"])
+    in_store[in_store] = store["pixel_index"][store_pixels[in_store]] == pixel_index[in_store]
+
+    return store_pixels[in_store].astype('int64'), labels[in_store]
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Helper functions to write the rasters of the pipeline.
+
+All rasters are written as tiled (512x512), compressed GeoTIFFs with internal overviews (see output_profile()),
+so windowed reads of later steps and map previews only decode the blocks they need:
+
+    compress  : COMPRESS (LZW, lossless) with a predictor, 2 for integer and 3 for floating point data
+    overviews : reduced resolution levels (2, 4, 8, ...) down to about BLOCKSIZE pixels, resampled with
+                nearest neighbour so nodata values are never mixed with valid values
+
+The binary water/non-water images of s04c and s04d are written in an even more compact format.
+A binary image only holds three values, so it is stored as uint8 GeoTIFF instead of with the float profile
+of the SAR image it was classified from:
+
+    1             : water (backscatter at or below the threshold)
+    0             : non-water
+    BINARY_NODATA : no backscatter (nodata or NaN in the SAR image)
+
+The GeoTIFF is tiled and DEFLATE compressed, which shrinks the mostly constant images to a fraction of
+their float size. Optionally a bit-packed NumPy sidecar (.bits.npz, 1 bit per pixel for water and for
+valid pixels) is written next to it, which later steps can load without decoding the GeoTIFF.
+"""
+import os
+
+import numpy as np
+
+import rasterio
+from rasterio.enums import Resampling
+
+BINARY_NODATA = 255
+BLOCKSIZE = 512
+# LZW is supported by every GDAL build, 'zstd' compresses better and faster where available
+COMPRESS = 'lzw'
+
+
+def output_profile(profile, **updates):
+    """
+    Function returns the profile to write a raster with, based on the profile of its input raster.
+
+    Parameters
+    ----------
+    profile : dict
+        Rasterio profile of the input raster (e.g. src.profile).
+    **updates :
+        Profile items to change, e.g. dtype='float32'. Can also override the compression.
+
+    Returns
+    -------
+    profile : dict
+        Tiled and compressed GeoTIFF profile.
+
+    """
+    profile = dict(profile)
+    profile.update(driver='GTiff', tiled=True, blockxsize=BLOCKSIZE, blockysize=BLOCKSIZE, compress=COMPRESS)
+    profile.update(updates)
+
+    if 'predictor' not in updates:
+        profile['predictor'] = 3 if np.issubdtype(np.dtype(profile['dtype']), np.floating) else 2
+    return profile
+
+
+def overview_levels(width, height):
+    """
+    Function returns the overview factors (2, 4, 8, ...) of a raster, down to about BLOCKSIZE pixels.
+    """
+    levels = []
+    factor = 2
+    while max(width, height) / factor >= BLOCKSIZE / 2:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def build_overviews(dst, resampling=Resampling.nearest):
+    """
+    Function builds the internal overviews of a raster that is completely written.
+    """
+    levels = overview_levels(dst.width, dst.height)
+    if levels:
+        dst.build_overviews(levels, resampling)
+        dst.update_tags(ns='rio_overview', resampling=resampling.name)
+
+
+def write_raster(filepath, image, profile, **updates):
+    """
+    Function writes an image as tiled, compressed GeoTIFF with overviews.
+
+    Parameters
+    ----------
+    filepath : string
+        Filepath of the GeoTIFF.
+    image : numpy array
+        Single band (height, width) or multiband (count, height, width) image.
+    profile : dict
+        Rasterio profile of the input raster, updated with output_profile().
+    **updates :
+        Profile items to change, see output_profile().
+
+    Returns
+    -------
+    None.
+
+    """
+    with rasterio.open(filepath, 'w', **output_profile(profile, **updates)) as dst:
+        if image.ndim == 2:
+            dst.write(image, 1)
+        else:
+            dst.write(image)
+        build_overviews(dst)
+
+
+def binary_profile(profile):
+    """
+    Function returns the profile of a binary image, based on the profile of the SAR image it is classified from.
+
+    Parameters
+    ----------
+    profile : dict
+        Rasterio profile of the SAR image.
+
+    Returns
+    -------
+    profile : dict
+        Single band uint8 profile, tiled and DEFLATE compressed.
+
+    """
+    return output_profile(profile, count=1, dtype='uint8', nodata=BINARY_NODATA, compress='deflate')
+
+
+def classify_binary(image, threshold, nodata=None, out=None):
+    """
+    Function classifies a SAR image (or any array of backscatter values) into a binary image.
+
+    Parameters
+    ----------
+    image : numpy array
+        Backscatter values, NaN pixels are nodata.
+    threshold : float
+        Threshold value, pixels at or below it are water.
+    nodata : float
+        Optional nodata value of the image, next to NaN.
+    out : numpy array
+        Optional uint8 array of the same shape the binary image is written to, e.g. to reuse it for every image.
+
+    Returns
+    -------
+    binary_image : uint8 numpy array with 1 for water, 0 for non-water and BINARY_NODATA for nodata.
+
+    """
+    if out is None:
+        out = np.empty(image.shape, dtype='uint8')
+
+    np.less_equal(image, threshold, out=out)
+    out[np.isnan(image)] = BINARY_NODATA
+    if nodata is not None:
+        out[image == nodata] = BINARY_NODATA
+    return out
+
+
+def bits_filepath(filepath):
+    return os.path.splitext(filepath)[0] + ".bits.npz"
+
+
+def write_binary(filepath, binary_image, profile, packbits=False):
+    """
+    Function writes a binary image as compact GeoTIFF and optionally as bit-packed sidecar.
+
+    Parameters
+    ----------
+    filepath : string
+        Filepath of the GeoTIFF.
+    binary_image : numpy array
+        Binary image returned by classify_binary().
+    profile : dict
+        Rasterio profile of the SAR image the binary image is classified from.
+    packbits : bool
+        Also write the bit-packed sidecar (see read_binary_bits()).
+
+    Returns
+    -------
+    None.
+
+    """
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with rasterio.open(filepath, 'w', **binary_profile(profile)) as dst:
+        dst.write(binary_image, 1)
+        build_overviews(dst)
+
+    if packbits:
+        np.savez(bits_filepath(filepath), shape=np.array(binary_image.shape),
+                 water=np.packbits(binary_image == 1, axis=None), valid=np.packbits(binary_image != BINARY_NODATA, axis=None))
+
+
+def read_binary_bits(filepath):
+    """
+    Function reads the bit-packed sidecar of a binary image.
+
+    Parameters
+    ----------
+    filepath : string
+        Filepath of the binary GeoTIFF (or of the sidecar itself).
+
+    Returns
+    -------
+    binary_image : uint8 numpy array, the same as the GeoTIFF.
+
+    """
+    if not filepath.endswith(".bits.npz"):
+        filepath = bits_filepath(filepath)
+
+    with np.load(filepath) as bits:
+        shape = tuple(bits["shape"])
+        size = int(np.prod(shape))
+        water = np.unpackbits(bits["water"], count=size).reshape(shape)
+        valid = np.unpackbits(bits["valid"], count=size).reshape(shape)
+
+    water[valid == 0] = BINARY_NODATA
+    return water
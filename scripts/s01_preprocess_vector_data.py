@@ -6,7 +6,15 @@ Created on Fri Jun  9 10:47:22 2023
 """
 import geopandas as gpd
 import pandas as pd
+import numpy as np
 import os
+import argparse
+import shapely
+from shapely.geometry import box
+from concurrent.futures import ProcessPoolExecutor
+
+from shared_datasets import get_dataset, put_dataset
+from vector_cache import read_vector
 
 #%% Functions
 def filterANLB(filepath, code_list):
@@ -23,11 +31,36 @@ def filterANLB(filepath, code_list):
     ANLB : filtered ANLB data
 
     """
-    ANLB = gpd.read_file(filepath).to_crs(32631)
+    ANLB = read_vector(filepath)
     # select plasdras areas
     ANLB = ANLB[ANLB["CODE_BEHEE"].isin(code_list)]
     return ANLB
 
+def read_brp_grasslands(filepath, bbox=None):
+    """
+    Function that reads only the grassland parcels of the BRP data. The attribute filter (and the
+    optional bounding box) is applied while reading the file, so other parcels are never loaded.
+
+    Parameters
+    ----------
+    filepath : path to the BRP shapefile
+    bbox : optional study area (minx, miny, maxx, maxy) in EPSG:32631
+
+    Returns
+    -------
+    BRP : BRP grassland parcels in EPSG:32631
+
+    """
+    read_kwargs = {"where": "cat_gewasc = 'Grasland'"}
+
+    # Only parcels intersecting the study area are read, the area is reprojected to the coordinate
+    # system of the BRP file while reading
+    if bbox is not None:
+        read_kwargs["mask"] = gpd.GeoSeries([box(*bbox)], crs=32631)
+
+    BRP = read_vector(filepath, **read_kwargs)
+    return BRP
+
 ### join BRP and ANLB data ################################################
 def joindataframes(df1, df2):
     """
@@ -36,6 +69,11 @@ def joindataframes(df1, df2):
     preserving the geometry of df1 (instead of the centroid geometry). The function adds a column
     and indicates "yes" when there was a join.
 
+    The centroids are queried in bulk against the spatial index (STRtree) of df2, so the join also
+    scales to large datasets. The result is the same as a left gpd.sjoin() of the centroids: df1 rows
+    are repeated for every intersecting df2 row, columns in both dataframes get the suffixes
+    '_left' and '_right' and the df2 index is stored in 'index_right'.
+
     Parameters
     ----------
     df1 : geopandas dataframe
@@ -46,35 +84,123 @@ def joindataframes(df1, df2):
     df1_df2 : joined geopandas dataframe
 
     """
-    # Add column and calculate centroids of the polygons
-    df1["Centroid"] = df1.centroid
-    
-    # Create new GeoDataframe and set geometry to the centroid column
-    df_centroid = gpd.GeoDataFrame(df1, geometry= df1["Centroid"])
-    
-    # Add the geometry of df1 back to preserve that geometry
-    df_centroid["polygon"] = df1.geometry
-    
-    # Drop 'Centroid'column since it is set in the geometry column
-    df_centroid_dropped = df_centroid.drop(['Centroid'], axis=1)
-    
-    # Join the centroid df with df2
-    df_join = gpd.sjoin(df_centroid_dropped, df2, how='left')
-    
-    # Create new GeoDataFrame where the original geometry column from df1 is set as the geometry column
-    df1_df2 = gpd.GeoDataFrame(df_join, geometry= df_join["polygon"])
-    
-    # Drop 'polygon'column since it is in the geometry column
-    df1_df2 = df1_df2.drop(["polygon"], axis=1)
-    
-    # Create 'Parcel_found'column and assign it 'yes'value
-    df1_df2["Parcel_found"] = "yes"
-    
-    # Assign the 'no' value when no fieldid is found
-    df1_df2["Parcel_found"] = df1_df2["fieldid"].apply(lambda x: 'yes' if pd.notnull(x) else 'no')
-    
+    # Query the centroids of df1 against the spatial index of df2 in one go
+    centroid_pos, df2_pos = df2.sindex.query(df1.centroid, predicate='intersects')
+
+    # Add the df1 rows without intersecting df2 row (left join), these get position -1
+    has_match = np.zeros(len(df1), dtype=bool)
+    has_match[centroid_pos] = True
+    unmatched_pos = np.flatnonzero(~has_match)
+    df1_pos = np.concatenate((centroid_pos, unmatched_pos))
+    df2_pos = np.concatenate((df2_pos, np.full(len(unmatched_pos), -1)))
+
+    # Keep the order of df1 (a stable sort keeps the order of multiple df2 rows of one df1 row)
+    order = np.argsort(df1_pos, kind='stable')
+    df1_pos, df2_pos = df1_pos[order], df2_pos[order]
+
+    # Columns present in both dataframes get a suffix, same as gpd.sjoin()
+    df2_columns = df2.columns.drop(df2.geometry.name)
+    shared_columns = df1.columns.intersection(df2_columns)
+
+    df1_part = df1.iloc[df1_pos].rename(columns={col: f"{col}_left" for col in shared_columns})
+
+    # Reindexing on the positions fills the unmatched rows (position -1) with NaN
+    df2_part = df2[df2_columns].reset_index(drop=True).reindex(df2_pos).rename(columns={col: f"{col}_right" for col in shared_columns})
+    df2_part.insert(0, "index_right", pd.Series(df2.index).reindex(df2_pos).values)
+    df2_part.index = df1_part.index
+
+    df1_df2 = gpd.GeoDataFrame(pd.concat([df1_part, df2_part], axis=1), geometry=df1.geometry.name, crs=df1.crs)
+
+    # Assign the 'yes' value when a fieldid is found, and 'no' when it is not
+    df1_df2["Parcel_found"] = np.where(df1_df2["fieldid"].notna(), 'yes', 'no')
+
     return df1_df2
 
+### reverse clip of the BRP sample ########################################
+def difference_chunk(geometries, neighbours):
+    """
+    Function that subtracts the union of the neighbouring geometries from every geometry of a chunk.
+
+    Parameters
+    ----------
+    geometries : array of shapely geometries
+    neighbours : list with an array of intersecting shapely geometries per geometry
+
+    Returns
+    -------
+    array of the differences
+
+    """
+    unions = [shapely.union_all(neighbour_geometries) for neighbour_geometries in neighbours]
+    return shapely.difference(geometries, unions)
+
+def make_valid_polygons(gdf):
+    """
+    Function that repairs invalid polygons, same as gpd.overlay() does with its inputs.
+    """
+    invalid = ~gdf.is_valid
+    if invalid.any():
+        gdf = gdf.copy()
+        gdf.loc[invalid, gdf.geometry.name] = gdf.loc[invalid].geometry.make_valid()
+    return gdf
+
+def difference_overlay(df1, df2, n_workers = 1, chunk_size = 500):
+    """
+    Function that removes the parts of the df1 polygons that overlap with df2, equal to
+    gpd.overlay(df1, df2, how='difference'). A spatial index (STRtree) of df2 is used to find the intersecting
+    pairs; polygons of df1 without intersecting df2 polygon are kept unchanged and the differences of the
+    other polygons are calculated in chunks, in parallel when n_workers > 1.
+
+    Parameters
+    ----------
+    df1 : geopandas dataframe
+    df2 : geopandas dataframe
+    n_workers : number of processes used, 1 calculates all differences in the current process
+    chunk_size : number of df1 polygons per chunk
+
+    Returns
+    -------
+    df1_diff : df1 with the remaining (non-empty) polygons and a new index
+
+    """
+    df1 = make_valid_polygons(df1)
+    df2_geometries = make_valid_polygons(df2).geometry.values
+
+    # Find all intersecting pairs, sorted on the df1 polygon. The tree is built on the repaired df2 polygons,
+    # the same geometries used for the differences
+    df1_pos, df2_pos = shapely.STRtree(df2_geometries).query(df1.geometry.values, predicate='intersects')
+    order = np.lexsort((df2_pos, df1_pos))
+    df1_pos, df2_pos = df1_pos[order], df2_pos[order]
+    intersecting_pos, group_start = np.unique(df1_pos, return_index=True)
+    neighbours = np.split(df2_geometries[df2_pos], group_start[1:]) if len(df1_pos) else []
+
+    # Only the intersecting polygons have to be processed, the others are kept unchanged
+    geometries = df1.geometry.values.copy()
+    chunks = [(geometries[intersecting_pos[i:i + chunk_size]], neighbours[i:i + chunk_size])
+              for i in range(0, len(intersecting_pos), chunk_size)]
+
+    if n_workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(difference_chunk, *zip(*chunks)))
+    else:
+        results = [difference_chunk(*chunk) for chunk in chunks]
+
+    if results:
+        # Repair the differences and keep only their polygons, as gpd.overlay() does
+        results = shapely.make_valid(np.concatenate(results))
+        collections = shapely.get_type_id(results) == 7
+        results[collections] = [shapely.union_all([part for part in shapely.get_parts(geometry)
+                                                   if part.geom_type in ('Polygon', 'MultiPolygon')])
+                                for geometry in results[collections]]
+        geometries[intersecting_pos] = results
+
+    differences = gpd.GeoSeries(geometries, index=df1.index, crs=df1.crs)
+
+    non_empty = ~differences.is_empty
+    df1_diff = df1[non_empty].copy()
+    df1_diff[df1_diff.geometry.name] = differences[non_empty]
+    return df1_diff.reset_index(drop=True)
+
 #%% Define filepaths
 
 #Input filepaths
@@ -90,75 +216,111 @@ joined_parcel_fp = "../output/01_subsidised_field.shp" #Moses uses this - to do:
 brp_grass_sample_fp ="../output/01_brp_grassland_sample_1000.shp" # 1000 BRP grassland parcels which exclude the ANLB parcels
 validation_parcel_fp = "../output/01_anlb_drygrass_merged.shp" # ANLB parcels merged with BRP grass only parcels for validation raster clip
 
-#%% Filter brp to graslands and write to file
-
-# Read in BRP parcel data
-brp_parcels_gdf = gpd.read_file(brp_parcels_fp).to_crs(32631)
-
-# Filter for Grassland parcels only
-grasland_brp_parcels = brp_parcels_gdf[brp_parcels_gdf['cat_gewasc'] == 'Grasland']
-
-# Write grassland parcels to file if it does not already exist
-if not os.path.exists(grassland_brp_fp):
-    grasland_brp_parcels.to_file(grassland_brp_fp)
-    print(f"{grassland_brp_fp} written to file.")
-else:
-    print (f"{grassland_brp_fp} already exists.")
-
-
-# Filter ANLB parcels to plasdras subsidy packages
-if os.path.exists(filtered_anlb_fp):
-    print(f"{filtered_anlb_fp} exists. Reading in as geodataframe...")
-    anlb_gdf = gpd.read_file(filtered_anlb_fp)
-else:
-    # filter ANLB data and safe it as a shapefile
-    code_list_ANLB = ['3a','3b','3c','3d']
-    anlb_gdf=filterANLB(anlb_parcel_filepaths,code_list_ANLB)
-   
-    anlb_gdf.to_file(filtered_anlb_fp)
-    #ANLB = gpd.read_file(filtered_anlb_fp)
-
-# Join BRP grasslands and ANLB data so that ANLB attribute table also contains BRP information 
-if os.path.exists(joined_parcel_fp):
-    print(f"{joined_parcel_fp} exists. Reading in as geodataframe...")
-    subsidised_field = gpd.read_file(joined_parcel_fp)
-else:
-    subsidised_field = joindataframes(anlb_gdf,grasland_brp_parcels)
-    
-    subsidised_field.to_file(joined_parcel_fp)
-
-#%% Create training and validation datasets containing only dry grass polygons
-# Load in the ANLB-subsidy parcels and BRP grassland parcels
-# anlb_gdf = gpd.read_file(filtered_anlb_fp)
-# brp_gdf = gpd.read_file(grassland_brp_fp)
-
-brp_large_parcels = grasland_brp_parcels[grasland_brp_parcels['area'] >= 30000] # Filter for parcels that are larger or equal to 30000 square meters
-
-# Clipping
-if os.path.exists(brp_grass_sample_fp):
-    print("BRP sampled dataset already exists")
-    gdf_brp_clip = gpd.read_file(brp_grass_sample_fp)
-else:
-    print("BRP sampled dataset does not exist yet")
-
-    # Randomly select 1000 polygons from the BRP data
-    gdf_brp_sample = brp_large_parcels.sample(n=1000, random_state=1)
-
-    # Conduct a reverse clip to make sure both vector files do not overlap
-    gdf_brp_clip = gpd.overlay(gdf_brp_sample, anlb_gdf, how='difference')
-    
-    # Export the BRP sampled dataset to file
-    gdf_brp_clip.to_file(brp_grass_sample_fp)
-    
-    print("BRP sampled dataset created \n")
-    
-
-
-# Merge/Combine multiple shapefiles into one
-anlb_gdf_drop =  anlb_gdf.drop(columns = 'Centroid')
-
-
-gdf_merged = gpd.GeoDataFrame(pd.concat([gdf_brp_clip, anlb_gdf_drop], ignore_index=True), crs=gdf_brp_clip.crs)
- 
-#Export merged geodataframe into shapefile
-gdf_merged.to_file(validation_parcel_fp)
+# Optional study area (minx, miny, maxx, maxy) in EPSG:32631, BRP parcels outside of it are not read. None reads all parcels
+study_area_bbox = None
+
+#%% Main function
+def main(n_workers=1, datasets=None):
+    """
+    Function that runs the entire script. Filters the BRP data to grasslands, filters the ANLB data
+    to subsidy packages 3a-d, joins both and creates the sample of dry grass BRP parcels.
+
+    Parameters
+    ----------
+    n_workers : number of processes used for the reverse clip of the BRP sample. Defaults to 1
+    datasets : dictionary of datasets shared with the other stages when the pipeline runs in a
+        single process (see shared_datasets.py). None reads everything from disk.
+
+    Returns
+    -------
+    None.
+
+    """
+    # Filter brp to graslands and write to file
+
+    # Read in BRP parcel data, filtered for Grassland parcels only while reading. The filtered parcels are
+    # shared under the filepath of the grassland file, not under the filepath of the complete BRP data
+    grasland_brp_parcels = get_dataset(datasets, grassland_brp_fp, lambda fp: read_brp_grasslands(brp_parcels_fp, study_area_bbox))
+
+    # Write grassland parcels to file if it does not already exist
+    if not os.path.exists(grassland_brp_fp):
+        grasland_brp_parcels.to_file(grassland_brp_fp)
+        print(f"{grassland_brp_fp} written to file.")
+    else:
+        print (f"{grassland_brp_fp} already exists.")
+
+
+    # Filter ANLB parcels to plasdras subsidy packages
+    if os.path.exists(filtered_anlb_fp):
+        print(f"{filtered_anlb_fp} exists. Reading in as geodataframe...")
+        anlb_gdf = get_dataset(datasets, filtered_anlb_fp, read_vector)
+    else:
+        # filter ANLB data and safe it as a shapefile
+        code_list_ANLB = ['3a','3b','3c','3d']
+        anlb_gdf=filterANLB(anlb_parcel_filepaths,code_list_ANLB)
+
+        anlb_gdf.to_file(filtered_anlb_fp)
+        put_dataset(datasets, filtered_anlb_fp, anlb_gdf)
+        #ANLB = gpd.read_file(filtered_anlb_fp)
+
+    # Join BRP grasslands and ANLB data so that ANLB attribute table also contains BRP information 
+    if os.path.exists(joined_parcel_fp):
+        print(f"{joined_parcel_fp} exists. Reading in as geodataframe...")
+        subsidised_field = get_dataset(datasets, joined_parcel_fp, read_vector)
+    else:
+        subsidised_field = joindataframes(anlb_gdf,grasland_brp_parcels)
+
+        subsidised_field.to_file(joined_parcel_fp)
+        put_dataset(datasets, joined_parcel_fp, subsidised_field)
+
+    # Create training and validation datasets containing only dry grass polygons
+    # Load in the ANLB-subsidy parcels and BRP grassland parcels
+    # anlb_gdf = gpd.read_file(filtered_anlb_fp)
+    # brp_gdf = gpd.read_file(grassland_brp_fp)
+
+    brp_large_parcels = grasland_brp_parcels[grasland_brp_parcels['area'] >= 30000] # Filter for parcels that are larger or equal to 30000 square meters
+
+    # Clipping
+    if os.path.exists(brp_grass_sample_fp):
+        print("BRP sampled dataset already exists")
+        gdf_brp_clip = get_dataset(datasets, brp_grass_sample_fp, read_vector)
+    else:
+        print("BRP sampled dataset does not exist yet")
+
+        # Randomly select 1000 polygons from the BRP data
+        gdf_brp_sample = brp_large_parcels.sample(n=1000, random_state=1)
+
+        # Conduct a reverse clip to make sure both vector files do not overlap
+        gdf_brp_clip = difference_overlay(gdf_brp_sample, anlb_gdf, n_workers)
+
+        # Export the BRP sampled dataset to file
+        gdf_brp_clip.to_file(brp_grass_sample_fp)
+        put_dataset(datasets, brp_grass_sample_fp, gdf_brp_clip)
+
+        print("BRP sampled dataset created \n")
+
+
+
+    # Merge/Combine multiple shapefiles into one
+    # (the 'Centroid' column only exists in older versions of the filtered ANLB data)
+    anlb_gdf_drop =  anlb_gdf.drop(columns = 'Centroid', errors = 'ignore')
+
+
+    gdf_merged = gpd.GeoDataFrame(pd.concat([gdf_brp_clip, anlb_gdf_drop], ignore_index=True), crs=gdf_brp_clip.crs)
+
+    #Export merged geodataframe into shapefile
+    gdf_merged.to_file(validation_parcel_fp)
+    put_dataset(datasets, validation_parcel_fp, gdf_merged)
+
+
+if __name__ == "__main__":
+    # create the parser
+    parser = argparse.ArgumentParser(description='Preprocessing of the BRP and ANLB parcels')
+
+    # add the argument
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used for the reverse clip of the BRP sample. Defaults to 1')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    main(args.workers)
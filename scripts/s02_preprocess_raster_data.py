@@ -6,23 +6,39 @@ Created on Fri Jun  9 10:08:02 2023
 """
 
 import os
-import sys
+import json
+import hashlib
+import argparse
+import threading
+import numpy as np
 import pandas as pd
 import shutil
 
 import geopandas as gpd
 import rasterio
 import rasterio.mask
+import shapely
+from rasterio.windows import Window
 
 from PIL import Image
-from rasterio.shutil import copy
 import glob
+from concurrent.futures import ProcessPoolExecutor
+
+from shared_datasets import get_dataset
+from vector_cache import read_vector
+from parcel_pixel_store import create_store, finish_store, store_exists
+from sar_cube import parse_sar_date
+from raster_io import write_raster
 
 
 #base = "D:\\RGIC23GR10\\"
 data_folder = "../data"
 output_folder = "../output"
 
+# Precomputed clip masks, shared by all scenes on the same grid (see get_clip_mask())
+clip_mask_folder = os.path.join(output_folder, "02_clip_masks")
+clip_masks = {}
+
 #%% Functions
 
 
@@ -98,8 +114,8 @@ def filter_og_SAR(infile, polarisation, fp_csv):
 
 def compress_images(src_dir, out_dir):
     """
-    Function to compress S1 images using LZW compression. Compressed images are stored in separate folder
-    and get a "_compressed.tif" suffix.
+    Function to compress S1 images with the output profile of all rasters of the pipeline (tiled, LZW compression
+    and overviews, see raster_io.py). Compressed images are stored in separate folder and get a "_compressed.tif" suffix.
 
     Parameters
     ----------
@@ -122,12 +138,132 @@ def compress_images(src_dir, out_dir):
             out_file_path = os.path.join(out_dir, os.path.splitext(file)[0] + "_compressed.tif")
 
             with rasterio.open(full_file_path) as src:
-                copy(src, out_file_path, driver='GTiff', compress='lzw')
+                write_raster(out_file_path, src.read(), src.profile)
 
     print("Image compression is done.")
 
+
+def load_clip_shapes(vector_fp, datasets=None):
+    """
+    Function reads the shapes used to clip the rasters, in EPSG:32631.
+
+    Parameters
+    ----------
+    vector_fp : TYPE string
+        DESCRIPTION. Shapefile filepath.
+    datasets : TYPE dictionary
+        DESCRIPTION. Datasets shared between the stages (see shared_datasets.py). None reads the shapefile from disk.
+
+    Returns
+    -------
+    shapes : TYPE array
+        DESCRIPTION. Shapely geometries as required by rasterio.mask().
+
+    """
+    if not os.path.exists(vector_fp):
+        raise FileNotFoundError(f"{vector_fp} does not exist. Please run script #1")
+
+    # Read in the shapefile
+    gdf = get_dataset(datasets, vector_fp, read_vector)
+
+    # Flatten the geometry into GeoJSON-like format as required by rasterio.mask()
+    shapes = gdf[['geometry']].values.flatten()
+    return shapes
+
+def is_up_to_date(output_fp, input_fps):
+    """
+    Function checks whether an output file exists and is newer than all of its input files.
+    """
+    if not os.path.exists(output_fp):
+        return False
+
+    output_mtime = os.path.getmtime(output_fp)
+    return all(os.path.getmtime(fp) <= output_mtime for fp in input_fps)
+
+def get_clip_mask(src, shapes, crop, invert):
+    """
+    Function returns the mask of the shapes on the grid of a raster, as computed by rasterio.mask.raster_geometry_mask()
+    with all_touched. Since all scenes share the same grid, the mask is computed only once per grid and set of shapes:
+    it is kept in memory and stored as .npy file in clip_mask_folder, which is memory-mapped by the other processes
+    and later runs.
+
+    Parameters
+    ----------
+    src : TYPE rasterio dataset
+        DESCRIPTION. Raster defining the grid.
+    shapes : TYPE array
+        DESCRIPTION. Shapely geometries.
+    crop : TYPE bool
+        DESCRIPTION. Crop the mask to the extent of the shapes.
+    invert : TYPE bool
+        DESCRIPTION. Mask the pixels inside instead of outside of the shapes.
+
+    Returns
+    -------
+    shape_mask : TYPE numpy array
+        DESCRIPTION. Boolean mask, True for the pixels to exclude.
+    transform : TYPE Affine
+        DESCRIPTION. Transform of the (cropped) mask.
+    window : TYPE Window
+        DESCRIPTION. Window of the mask in the raster, None when not cropped.
+
+    """
+    # Key on the grid, the exact geometries and the options
+    grid = [src.crs.to_wkt(), list(src.transform)[:6], src.width, src.height]
+    shapes_digest = hashlib.sha1(b"".join(shapely.to_wkb(np.asarray(shapes)))).hexdigest()
+    key = hashlib.sha1(json.dumps([grid, shapes_digest, crop, invert]).encode()).hexdigest()
+
+    if key not in clip_masks:
+        mask_fp = os.path.join(clip_mask_folder, f"{key}.npy")
+        info_fp = os.path.join(clip_mask_folder, f"{key}.json")
+
+        if not (os.path.exists(mask_fp) and os.path.exists(info_fp)):
+            shape_mask, transform, window = rasterio.mask.raster_geometry_mask(src, shapes, all_touched=True, crop=crop, invert=invert)
+
+            # Write to temporary files first, so other processes never read an incomplete mask.
+            # The suffix is unique per process and thread, so concurrent writers of the same mask never share a file
+            os.makedirs(clip_mask_folder, exist_ok=True)
+            tmp_suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(mask_fp + tmp_suffix, "wb") as f:
+                np.save(f, shape_mask)
+            with open(info_fp + tmp_suffix, "w") as f:
+                json.dump({"transform": list(transform)[:6],
+                           "window": None if window is None else [window.col_off, window.row_off, window.width, window.height]}, f)
+            os.replace(mask_fp + tmp_suffix, mask_fp)
+            os.replace(info_fp + tmp_suffix, info_fp)
+
+        with open(info_fp) as f:
+            info = json.load(f)
+
+        window = None if info["window"] is None else Window(*info["window"])
+        clip_masks[key] = (np.load(mask_fp, mmap_mode="r"), rasterio.Affine(*info["transform"]), window)
+
+    return clip_masks[key]
+
+def mask_raster(src, shapes, nodata, crop=False, invert=False):
+    """
+    Function masks a raster with shapes, equal to rasterio.mask.mask() with all_touched, but reusing the
+    precomputed mask of get_clip_mask(). Only the window of the mask is read and pixels outside of the
+    shapes (or inside with invert) and nodata pixels are set to nodata.
+    """
+    shape_mask, transform, window = get_clip_mask(src, shapes, crop, invert)
+
+    out_image = src.read(window=window, masked=True)
+    out_image = np.where(np.ma.getmaskarray(out_image) | shape_mask, nodata, out_image.data).astype(src.dtypes[0])
+
+    return out_image, transform
+
+# Shapes used by the clip functions in a worker process, set once per process by init_worker()
+worker_shapes = None
+
+def init_worker(shapes):
+    global worker_shapes
+    worker_shapes = shapes
+
+def clip_worker(clip_func, raster_fp, vector_fp, output_fp):
+    clip_func(raster_fp, vector_fp, output_fp, shapes=worker_shapes)
         
-def clip_raster_mixedpixel(raster_fp, vector_fp, output_fp):
+def clip_raster_mixedpixel(raster_fp, vector_fp, output_fp, datasets=None, shapes=None):
     """
     Function clips input raster based on parcel shapefile. 
     The output raster countains backscatter values of mixed pixels, i.e., pixels that touch the parcel polygons.
@@ -141,6 +277,10 @@ def clip_raster_mixedpixel(raster_fp, vector_fp, output_fp):
         DESCRIPTION. vector_fp : Input shapefile filepath. The shapefile should be the ANLB parcel polygons.
     output_fp : TYPE string
         DESCRIPTION. Output clipped raster filepath.
+    datasets : TYPE dictionary
+        DESCRIPTION. Datasets shared between the stages (see shared_datasets.py). None reads the shapefile from disk.
+    shapes : TYPE array
+        DESCRIPTION. Shapes already loaded with load_clip_shapes(). None reads them from vector_fp.
 
     Returns
     -------
@@ -149,29 +289,14 @@ def clip_raster_mixedpixel(raster_fp, vector_fp, output_fp):
 
     """
 
-    # Create filepath
-    fp_anlb = os.path.join(output_folder, vector_fp)
-    
-    print(fp_anlb)
-
     output_raster_path = output_fp
     
-    if os.path.exists(fp_anlb):
-        #print("01_ANLB_filtered.shp exists") # Use for error-handling. Removed due to spam
-        
-        # Read in the shapefile
-        gdf = gpd.read_file(fp_anlb).to_crs(32631)
-        
-        # Flatten the geometry into GeoJSON-like format as required by rasterio.mask()
-        shapes = gdf[['geometry']].values.flatten()
-        
-    else: 
-        print("Filtered ANLB file does not exist. Please run script #1")
-        sys.exit()     
+    if shapes is None:
+        shapes = load_clip_shapes(os.path.join(output_folder, vector_fp), datasets)
 
     with rasterio.open(raster_fp) as src:
 
-        out_image, out_transform = rasterio.mask.mask(src, shapes, crop=True, nodata=999, all_touched = True)
+        out_image, out_transform = mask_raster(src, shapes, nodata=999, crop=True)
         out_meta = src.meta
 
     out_meta.update({"driver": "GTiff",
@@ -180,12 +305,13 @@ def clip_raster_mixedpixel(raster_fp, vector_fp, output_fp):
                       "transform": out_transform})
 
 
-    with rasterio.open(output_raster_path, "w", **out_meta) as dest:
-        dest.write(out_image)
+    # Write to a temporary file first, so an interrupted run never leaves an incomplete clipping behind
+    write_raster(output_raster_path + ".tmp", out_image, out_meta)
+    os.replace(output_raster_path + ".tmp", output_raster_path)
         
-        print(f"{output_raster_path} was written to file")
+    print(f"{output_raster_path} was written to file")
 
-def clip_raster_purepixel(raster_fp, vector_fp, output_fp):
+def clip_raster_purepixel(raster_fp, vector_fp, output_fp, datasets=None, shapes=None):
     """
     Function clips input raster based on parcel perimeter shapefile. 
     The output raster countains only backscatter values for pixels that lie purely inside parcel.
@@ -198,6 +324,10 @@ def clip_raster_purepixel(raster_fp, vector_fp, output_fp):
         DESCRIPTION. Input shapefile filepath. The shapefile should be the line perimeter of the parcel polygons.
     output_fp : TYPE string
         DESCRIPTION. Output clipped raster filepath.
+    datasets : TYPE dictionary
+        DESCRIPTION. Datasets shared between the stages (see shared_datasets.py). None reads the shapefile from disk.
+    shapes : TYPE array
+        DESCRIPTION. Shapes already loaded with load_clip_shapes(). None reads them from vector_fp.
 
     Returns
     -------
@@ -206,16 +336,12 @@ def clip_raster_purepixel(raster_fp, vector_fp, output_fp):
 
     """
       
-    
-    # Read in the shapefile
-    gdf = gpd.read_file(vector_fp).to_crs(32631)
-    
-    # Flatten the geometry into GeoJSON-like format as required by rasterio.mask()
-    shapes = gdf[['geometry']].values.flatten()
+    if shapes is None:
+        shapes = load_clip_shapes(vector_fp, datasets)
 
     with rasterio.open(raster_fp) as src:
 
-        out_image, out_transform = rasterio.mask.mask(src, shapes, nodata=999, all_touched = True, invert = True)
+        out_image, out_transform = mask_raster(src, shapes, nodata=999, invert=True)
         out_meta = src.meta
 
     out_meta.update({"driver": "GTiff",
@@ -224,14 +350,17 @@ def clip_raster_purepixel(raster_fp, vector_fp, output_fp):
                       "transform": out_transform})
 
 
-    with rasterio.open(output_fp, "w", **out_meta) as dest:
-        dest.write(out_image)
+    # Write to a temporary file first, so an interrupted run never leaves an incomplete clipping behind
+    write_raster(output_fp + ".tmp", out_image, out_meta)
+    os.replace(output_fp + ".tmp", output_fp)
         
-        print(f"{output_fp} was written to file")
+    print(f"{output_fp} was written to file")
     
-def process_rasters(polarisation, clipfunction, shapefile, source_folder):
+def process_rasters(polarisation, clipfunction, shapefile, source_folder, datasets=None, n_workers=1):
     """
-    Function to batch clip the SAR raster images to either pure or mixed pixels
+    Function to batch clip the SAR raster images to either pure or mixed pixels. The shapes are loaded only
+    once for all rasters. Rasters of which the clipped output already exists and is newer than the raster
+    and the shapefile are skipped, so an interrupted run continues where it stopped.
 
     Parameters
     ----------
@@ -246,6 +375,10 @@ def process_rasters(polarisation, clipfunction, shapefile, source_folder):
     shapefile : TYPE shapefile
         DESCRIPTION. The shapefile you want to use to clip your raster to. In case of mixed pixel clipping, use
         parcel shapes. For pure pixel use the line perimeter of parcels.
+    datasets : TYPE dictionary
+        DESCRIPTION. Datasets shared between the stages (see shared_datasets.py). None reads the shapefile from disk.
+    n_workers : TYPE int
+        DESCRIPTION. Number of processes used to clip the rasters. 1 clips all rasters in the current process.
 
     Returns
     -------
@@ -255,36 +388,130 @@ def process_rasters(polarisation, clipfunction, shapefile, source_folder):
     # Create filepath + destination folder if it does not yet exist
     destination_folder = os.path.join(output_folder, f"02_{polarisation}_{clipfunction}_clipped")
     os.makedirs(destination_folder, exist_ok=True)
-     
+
+    if clipfunction == "mp":
+        clip_func = clip_raster_mixedpixel
+        # The mixed pixel shapefile is given relative to the output folder
+        vector_fp = os.path.join(output_folder, shapefile)
+        
+    elif clipfunction == "pp": 
+        clip_func = clip_raster_purepixel
+        vector_fp = shapefile
+        
+    else:
+        print ('This clip function does not exist.')
+        return
 
     # Get a list of .tif files in the source folder
     #file_list = glob.glob(os.path.join(source_folder, '*.tif'))
-    file_list = glob.glob(source_folder)
+    file_list = sorted(glob.glob(source_folder))
+
+    # Load the shapes once for all rasters
+    shapes = load_clip_shapes(vector_fp, datasets)
+    vector_fps = glob.glob(glob.escape(os.path.splitext(vector_fp)[0]) + ".*")
     
-    # Iterate through each file
+    # Collect the rasters which still have to be clipped
+    jobs = []
     for file_path in file_list:
         # Get the filename and extension
         filename = os.path.splitext(os.path.basename(file_path))[0]
 
         # Create the new filename
         if clipfunction == "mp":
-            clip_func = clip_raster_mixedpixel
             new_filename = f"02_{filename}_mp_clip.tif"
-            
-        elif clipfunction == "pp": 
-            # Note that pure-pixel is based on mixed-pixel clipping, therefore the name is different
-            clip_func = clip_raster_purepixel
-            new_filename = filename.replace("_mp_clip", "_pp_clip")
-            
         else:
-            print ('This clip function does not exist.')
+            # Note that pure-pixel is based on mixed-pixel clipping, therefore the name is different
+            new_filename = filename.replace("_mp_clip", "_pp_clip") + ".tif"
 
         # Construct the output file path
         output_path = os.path.join(destination_folder, new_filename)
 
-        # Apply the clip function to the raster
-        #clipfunction(file_path, shapefile, output_path)
-        clip_func(file_path, shapefile, output_path)
+        if is_up_to_date(output_path, [file_path] + vector_fps):
+            print(f"{output_path} is up to date")
+        else:
+            jobs.append((file_path, output_path))
+
+    # Apply the clip function to the rasters
+    if n_workers > 1 and len(jobs) > 1:
+        # Compute the clip mask once beforehand, the workers memory-map it instead of each computing it
+        with rasterio.open(jobs[0][0]) as src:
+            get_clip_mask(src, shapes, crop=(clipfunction == "mp"), invert=(clipfunction == "pp"))
+
+
+        # Every worker receives the shapes once and then clips one raster at a time
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(shapes,)) as executor:
+            futures = [executor.submit(clip_worker, clip_func, file_path, shapefile, output_path) for file_path, output_path in jobs]
+            for future in futures:
+                future.result()
+    else:
+        for file_path, output_path in jobs:
+            clip_func(file_path, shapefile, output_path, datasets, shapes)
+
+
+def write_parcel_pixel_store(polarisation, shapefile, source_folder, datasets=None):
+    """
+    Function writes the parcel-pixel store of all SAR images (see parcel_pixel_store.py): the values of only the
+    pixels of the parcels, the same pixels and values as the mixed pixel clipping. The store is skipped when it is
+    newer than all images and the shapefile.
+
+    Parameters
+    ----------
+    polarisation : TYPE string
+        DESCRIPTION. Polarisation of the SAR images, VV or VH.
+    shapefile : TYPE string
+        DESCRIPTION. Shapefile (relative to the output folder) with the parcels, same as for the mixed pixel clipping.
+    source_folder : TYPE string
+        DESCRIPTION. Glob pattern of the SAR images.
+    datasets : TYPE dictionary
+        DESCRIPTION. Datasets shared between the stages (see shared_datasets.py). None reads the shapefile from disk.
+
+    Returns
+    -------
+    None.
+
+    """
+    store_folder = os.path.join(output_folder, f"02_{polarisation}_parcel_pixels")
+    vector_fp = os.path.join(output_folder, shapefile)
+    file_list = sorted(glob.glob(source_folder))
+
+    if not file_list:
+        print(f"No images found for {source_folder}")
+        return
+
+    vector_fps = glob.glob(glob.escape(os.path.splitext(vector_fp)[0]) + ".*")
+    if store_exists(store_folder) and is_up_to_date(os.path.join(store_folder, "store.json"), file_list + vector_fps):
+        with open(os.path.join(store_folder, "store.json")) as f:
+            if json.load(f)["filenames"] == [os.path.basename(fp) for fp in file_list]:
+                print(f"{store_folder} is up to date")
+                return
+
+    shapes = load_clip_shapes(vector_fp, datasets)
+
+    with rasterio.open(file_list[0]) as src:
+        grid = (src.crs, src.transform, src.shape)
+        shape_mask, transform, window = get_clip_mask(src, shapes, crop=True, invert=False)
+
+    # The parcel pixels on the clipped grid, the scripts reading the store label them with their own parcels
+    pixel_index = np.flatnonzero(~shape_mask)
+
+    values = create_store(store_folder, pixel_index, len(file_list))
+    dates = []
+
+    for t, file_path in enumerate(file_list):
+        with rasterio.open(file_path) as src:
+            if (src.crs, src.transform, src.shape) != grid:
+                raise ValueError(f"{file_path} does not share the grid of the other images. Please check the SAR images")
+
+            out_image, _ = mask_raster(src, shapes, nodata=999, crop=True)
+
+        values[t] = out_image[0].ravel()[pixel_index]
+
+        dates.append(parse_sar_date(file_path).strftime("%Y%m%d"))
+
+    finish_store(store_folder, values, dates, [os.path.basename(fp) for fp in file_list],
+                 grid[0], transform, shape_mask.shape[1], shape_mask.shape[0])
+
+    print(f"{store_folder} was written to file ({len(pixel_index)} pixels, {len(file_list)} dates)")
 
 
 def copy_raw_sar(input_folder, output_folder, sar_files):
@@ -315,58 +542,105 @@ def copy_raw_sar(input_folder, output_folder, sar_files):
         # Full path to the file in the output folder (where it will go)
         dest = os.path.join(output_folder, file_name)
         
-        # If the file exists in the input folder, then move it
+        # If the file exists in the input folder, then copy it. Copies that are up to date are kept, and the
+        # modification time of the source is kept as well, so the copies only change when the source changed
         if os.path.exists(source):
-            shutil.copy(source, dest)
+            if not is_up_to_date(dest, [source]):
+                shutil.copy2(source, dest)
         else:
             print(f"File {file_name} does not exist in the input folder.")
 
     
     
         
-#%% Filter from original S1 data folder, only the backscatter .tif files obtained via central pass during study period. 
+#%% Main function
+def main(polarisations=("VV", "VH"), n_workers=1, output="both", datasets=None):
+    """
+    Function that runs the entire script. Copies the SAR images closest to the ground truth water data
+    and clips the SAR images to the merged ANLB and BRP parcels.
 
-# filter_og_SAR("data/S1/", "VV", "S1/Sentinel_1A_2021_overview.csv") # VV polarisation
-# filter_og_SAR("data/S1/", "VH", "S1/Sentinel_1A_2021_overview.csv") # VH polarisation
+    Parameters
+    ----------
+    polarisations : TYPE list of strings
+        DESCRIPTION. Polarisations to process, VV and/or VH.
+    n_workers : TYPE int
+        DESCRIPTION. Number of processes used to clip the rasters. Defaults to 1.
+    output : TYPE string
+        DESCRIPTION. Write the clipped GeoTIFFs ("tiff"), the parcel-pixel store ("store") or both ("both").
+    datasets : TYPE dictionary
+        DESCRIPTION. Datasets shared between the stages (see shared_datasets.py). None reads everything from disk.
 
-# Get SAR images closest to ground truth water information obtained from S2 data. 
-vv_files = ["Sigma0_dB_VV_20210221.tif", "Sigma0_dB_VV_20210305.tif", "Sigma0_dB_VV_20210329.tif", "Sigma0_dB_VV_20210410.tif", "Sigma0_dB_VV_20210422.tif", "Sigma0_dB_VV_20210504.tif", "Sigma0_dB_VV_20210528.tif", "Sigma0_dB_VV_20210609.tif", "Sigma0_dB_VV_20210621.tif"]
-vh_files = ["Sigma0_dB_VH_20210221.tif", "Sigma0_dB_VH_20210305.tif", "Sigma0_dB_VH_20210329.tif", "Sigma0_dB_VH_20210410.tif", "Sigma0_dB_VH_20210422.tif", "Sigma0_dB_VH_20210504.tif", "Sigma0_dB_VH_20210528.tif", "Sigma0_dB_VH_20210609.tif", "Sigma0_dB_VH_20210621.tif"]
+    Returns
+    -------
+    None.
 
-copy_raw_sar("../data/S1_VV_filtered", "../data/thresholding_data/training/vvsar", vv_files) # move files for vv polarization
-copy_raw_sar("../data/S1_VH_filtered", "../data/thresholding_data/training/vhsar", vh_files) # move files for vv polarization 
+    """
+    # Filter from original S1 data folder, only the backscatter .tif files obtained via central pass during study period. 
 
-#%% OPTIONAL : Compress all .tif images provided in separate date subdirectories and store all outputs in same file
-# define source and output directories
-"""
-OPTIONAL COMPRESSION
-src_dir = data_folder + "S1A_VV_filtered" 
-out_dir = data_folder + "S1A_VV_filtered_compressed"
-compress_images(src_dir, out_dir) 
-"""
+    # filter_og_SAR("data/S1/", "VV", "S1/Sentinel_1A_2021_overview.csv") # VV polarisation
+    # filter_og_SAR("data/S1/", "VH", "S1/Sentinel_1A_2021_overview.csv") # VH polarisation
 
-#%% Clip both mixed pixels and pure pixels 
+    # Get SAR images closest to ground truth water information obtained from S2 data. 
+    vv_files = ["Sigma0_dB_VV_20210221.tif", "Sigma0_dB_VV_20210305.tif", "Sigma0_dB_VV_20210329.tif", "Sigma0_dB_VV_20210410.tif", "Sigma0_dB_VV_20210422.tif", "Sigma0_dB_VV_20210504.tif", "Sigma0_dB_VV_20210528.tif", "Sigma0_dB_VV_20210609.tif", "Sigma0_dB_VV_20210621.tif"]
+    vh_files = ["Sigma0_dB_VH_20210221.tif", "Sigma0_dB_VH_20210305.tif", "Sigma0_dB_VH_20210329.tif", "Sigma0_dB_VH_20210410.tif", "Sigma0_dB_VH_20210422.tif", "Sigma0_dB_VH_20210504.tif", "Sigma0_dB_VH_20210528.tif", "Sigma0_dB_VH_20210609.tif", "Sigma0_dB_VH_20210621.tif"]
 
-# Mixed pixel clipping
-process_rasters("VV", "mp", "01_anlb_drygrass_merged.shp", os.path.join(data_folder, "S1_VV_filtered/", "*.tif"))
-process_rasters("VH", "mp", "01_anlb_drygrass_merged.shp", os.path.join(data_folder, "S1_VH_filtered/", "*.tif"))
+    if "VV" in polarisations:
+        copy_raw_sar("../data/S1_VV_filtered", "../data/thresholding_data/training/vvsar", vv_files) # move files for vv polarization
+    if "VH" in polarisations:
+        copy_raw_sar("../data/S1_VH_filtered", "../data/thresholding_data/training/vhsar", vh_files) # move files for vh polarization 
 
+    # OPTIONAL : Compress all .tif images provided in separate date subdirectories and store all outputs in same file
+    # define source and output directories
+    """
+    OPTIONAL COMPRESSION
+    src_dir = data_folder + "S1A_VV_filtered" 
+    out_dir = data_folder + "S1A_VV_filtered_compressed"
+    compress_images(src_dir, out_dir) 
+    """
 
-"""
- OPTIONAL: Pure pixel clipping in case SAR images have to clipped to only pixels lying completely within parcel boundaries
- 
-#src_raster_mp = mixed_pixel_fp
-#anlb_perimeter_fp = data_folder + "02_anlb_perimeter.shp"
-#pure_pixel_fp = output_folder + "02_VV_purepixel_clipped\\"
+    # Clip both mixed pixels and pure pixels 
 
-# Load in the ANLB data and retrieve ONLY the boundaries of polygons
-anlb_perimeter = gpd.read_file(output_folder + "\\01_ANLB_filtered.shp").to_crs(32631).boundary
+    # Mixed pixel clipping
+    for polarisation in polarisations:
+        if output in ("tiff", "both"):
+            process_rasters(polarisation, "mp", "01_anlb_drygrass_merged.shp", os.path.join(data_folder, f"S1_{polarisation}_filtered/", "*.tif"), datasets, n_workers)
 
-fp_anlb_perimeter = os.path.join(data_folder, "02_anlb_perimeter.shp")
-anlb_perimeter.to_file(fp_anlb_perimeter)
+        # Compact store of only the parcel pixels, read by s03 and s04c with --source store
+        if output in ("store", "both"):
+            write_parcel_pixel_store(polarisation, "01_anlb_drygrass_merged.shp", os.path.join(data_folder, f"S1_{polarisation}_filtered/", "*.tif"), datasets)
 
-process_rasters("VV", "pp", fp_anlb_perimeter, os.path.join(output_folder, "02_VV_mp_clipped/", "*.tif"))
-process_rasters("VH", "pp", fp_anlb_perimeter, os.path.join(output_folder, "02_VH_mp_clipped/", "*.tif"))
 
-"""
+    """
+     OPTIONAL: Pure pixel clipping in case SAR images have to clipped to only pixels lying completely within parcel boundaries
+
+    #src_raster_mp = mixed_pixel_fp
+    #anlb_perimeter_fp = data_folder + "02_anlb_perimeter.shp"
+    #pure_pixel_fp = output_folder + "02_VV_purepixel_clipped\\"
+
+    # Load in the ANLB data and retrieve ONLY the boundaries of polygons
+    anlb_perimeter = gpd.read_file(output_folder + "\\01_ANLB_filtered.shp").to_crs(32631).boundary
+
+    fp_anlb_perimeter = os.path.join(data_folder, "02_anlb_perimeter.shp")
+    anlb_perimeter.to_file(fp_anlb_perimeter)
+
+    process_rasters("VV", "pp", fp_anlb_perimeter, os.path.join(output_folder, "02_VV_mp_clipped/", "*.tif"))
+    process_rasters("VH", "pp", fp_anlb_perimeter, os.path.join(output_folder, "02_VH_mp_clipped/", "*.tif"))
 
+    """
+
+
+if __name__ == "__main__":
+    # create the parser
+    parser = argparse.ArgumentParser(description='Preprocessing of the Sentinel-1 images')
+    
+    # add the argument
+    parser.add_argument('--polarisation', choices=['VV', 'VH'], nargs='+', default=['VV', 'VH'], 
+                        help='Polarisation(s) to process. Defaults to both VV and VH')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used to clip the rasters. Defaults to 1')
+    parser.add_argument('--output', choices=['tiff', 'store', 'both'], default='both',
+                        help='Write the clipped GeoTIFFs, the parcel-pixel store or both. Defaults to both')
+    
+    # parse the arguments
+    args = parser.parse_args()
+    
+    main(args.polarisation, args.workers, args.output)
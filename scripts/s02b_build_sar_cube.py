@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Stacks the clipped SAR images of s02 per polarisation into a single dated time-series cube
+(see sar_cube.py), so later scripts can select scenes by date range and pixel window without
+opening the images one by one.
+"""
+
+import os
+import glob
+import json
+import argparse
+
+import numpy as np
+import rasterio
+
+from sar_cube import parse_sar_date, cube_filepaths, create_cube, finish_cube
+
+output_folder = "../output"
+
+#%% Functions
+
+def build_cube(polarisation, source_folder, cube_folder, nodata=999):
+    """
+    Function stacks all clipped images of a polarisation into a (time, y, x) cube ordered by date.
+    Nodata pixels (999) are stored as NaN. The cube is skipped when it is newer than all images.
+
+    Parameters
+    ----------
+    polarisation : TYPE string
+        DESCRIPTION. Polarisation of the SAR images, VV or VH.
+    source_folder : TYPE string
+        DESCRIPTION. Folder containing the clipped images of s02.
+    cube_folder : TYPE string
+        DESCRIPTION. Folder the cube is written to.
+    nodata : TYPE float
+        DESCRIPTION. Nodata value of the clipped images.
+
+    Returns
+    -------
+    None.
+
+    """
+    file_list = sorted(glob.glob(os.path.join(source_folder, "*.tif")), key=parse_sar_date)
+
+    if not file_list:
+        print(f"No clipped images found in {source_folder}. Please run script #2")
+        return
+
+    # Skip the cube if it already contains exactly these images and is newer than all of them
+    _, meta_fp = cube_filepaths(cube_folder, polarisation)
+    if os.path.exists(meta_fp) and all(os.path.getmtime(fp) <= os.path.getmtime(meta_fp) for fp in file_list):
+        with open(meta_fp) as f:
+            if json.load(f)["filenames"] == [os.path.basename(fp) for fp in file_list]:
+                print(f"{meta_fp} is up to date")
+                return
+
+    with rasterio.open(file_list[0]) as src:
+        grid = (src.crs, src.transform, src.shape)
+
+    values = create_cube(cube_folder, polarisation, len(file_list), *grid[2])
+
+    for t, file_path in enumerate(file_list):
+        with rasterio.open(file_path) as src:
+            if (src.crs, src.transform, src.shape) != grid:
+                raise ValueError(f"{file_path} does not share the grid of the other images. Please check the clipped images")
+
+            # Read directly into the cube
+            src.read(1, out=values[t])
+
+        values[t][values[t] == nodata] = np.nan
+        print(f"{os.path.basename(file_path)} added to the {polarisation} cube")
+
+    finish_cube(cube_folder, polarisation, values, [parse_sar_date(fp) for fp in file_list],
+                [os.path.basename(fp) for fp in file_list], grid[0], grid[1])
+
+    print(f"{polarisation} cube with {len(file_list)} dates written to {cube_folder}")
+
+#%% Main function
+def main(polarisations=("VV", "VH"), datasets=None):
+    """
+    Function that runs the entire script. Builds the time-series cube of every polarisation.
+
+    Parameters
+    ----------
+    polarisations : TYPE list of strings
+        DESCRIPTION. Polarisations to process, VV and/or VH.
+    datasets : TYPE dictionary
+        DESCRIPTION. Datasets shared between the stages (see shared_datasets.py), not used by this script.
+
+    Returns
+    -------
+    None.
+
+    """
+    for polarisation in polarisations:
+        build_cube(polarisation, os.path.join(output_folder, f"02_{polarisation}_mp_clipped"), output_folder)
+
+
+if __name__ == "__main__":
+    # create the parser
+    parser = argparse.ArgumentParser(description='Time-series cube of the clipped Sentinel-1 images')
+
+    # add the argument
+    parser.add_argument('--polarisation', choices=['VV', 'VH'], nargs='+', default=['VV', 'VH'],
+                        help='Polarisation(s) to process. Defaults to both VV and VH')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    main(args.polarisation)
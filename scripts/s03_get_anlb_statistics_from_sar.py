@@ -6,20 +6,26 @@ Created on Mon Jun 12 11:35:09 2023
 """
 
 import os
+import json
+import hashlib
+import threading
+import argparse
+import warnings
 import rasterio
 import pandas as pd
 import geopandas as gpd
 import numpy as np
 from shapely.geometry import Polygon
-from rasterstats import zonal_stats
+from rasterio.windows import Window
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 import seaborn as sns
 
-# %% Read in files
-# First load in the ANLB-subsidy and BRP data
-gdf_anlb = gpd.read_file("../data/01_ANLB_filtered.shp")
-gdf_brp_clip = gpd.read_file("../output/01_brp_grassland_sample_1000.shp")
-
+from shared_datasets import get_dataset
+from vector_cache import read_vector
+from parcel_pixel_store import open_store, pixel_labels
+from parcel_labels import polygon_pixels
+from sar_cube import parse_sar_date
 
 # %% Define equations
 def create_vector(extent):
@@ -42,28 +48,101 @@ def create_vector(extent):
     return gdf
 
 
-# Load raster files and add the transform
-def load_raster(filepath):
-    """ 
+def vector_pixel_index(vector_sets, shape, transform):
+    """
+    This function does the following things:
+        1. Find the pixels of every polygon of every vector set in the grid of the SAR images
+        2. Polygons are labelled by their position (starting at 1)
+        3. Only these pixels are kept, as (flat index, label) pairs sorted by flat index (see parcel_labels.py),
+           instead of a label grid covering the window of the vector set (almost the full national scene)
+    
+    Inputs
+    - 'vector_sets' is a dictionary with the vector name as key and the GeoDataFrame as value
+    - 'shape' and 'transform' are the grid of the SAR images
+    
+    Returns a dictionary with the vector name as key and the flat pixel index and labels as value
+    
+    NOTE: the vector sets overlap each other (e.g., the representative pixels lie within the ANLB parcels) and so
+    can the polygons within a set. A pixel shared by multiple polygons is listed once for every polygon,
+    so every polygon keeps all of its pixels like with zonal_stats
+    """
+    return {vector_name: polygon_pixels(vector.geometry.values, shape, transform) for vector_name, vector in vector_sets.items()}
+
+def read_pixels(src, pixel_index, strip_height=512):
+    """
+    This function does the following things:
+        1. Split the pixels (sorted flat index in the image) into strips of 'strip_height' rows
+        2. Only read the strips containing pixels, limited to the columns of these pixels
+        3. Gather the values of the pixels, so at most one strip of the national scene is held in memory
+    """
+    values = np.empty(len(pixel_index), dtype=src.dtypes[0])
+    if len(pixel_index) == 0:
+        return values
+    
+    rows, cols = np.divmod(pixel_index, src.width)
+    strips = rows // strip_height
+    
+    # Pixels are sorted by row, so every strip is a slice
+    bounds = np.flatnonzero(np.diff(strips)) + 1
+    for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(pixel_index)]):
+        row_start, row_stop = rows[start], rows[stop - 1] + 1
+        col_start, col_stop = cols[start:stop].min(), cols[start:stop].max() + 1
+        
+        strip = src.read(1, window=Window(col_start, row_start, col_stop - col_start, row_stop - row_start))
+        values[start:stop] = strip[rows[start:stop] - row_start, cols[start:stop] - col_start]
+    
+    return values
+
+def polygon_stats(values, labels, n_polygons):
+    """
     This function does the following things:
-        1. Load .tif files as Numpy arrays
-        2. And returns transform required to georeference the array with the vector data
+        1. Group all valid pixel values (not NaN) by their polygon label
+        2. Compute the count, minimum, mean, maximum and median of every polygon in one vectorized pass
+    
+    Polygons without any pixels receive a count of 0 and NaN for the other statistics,
+    similar to the None values returned by zonal_stats
     """
-    with rasterio.open(filepath, driver='GTiff')  as src:
-        return src.read(1), src.transform
+    valid = ~np.isnan(values)
+    polygon_labels = labels[valid]
+    values = values[valid].astype(np.float64)
+    
+    count = np.bincount(polygon_labels, minlength=n_polygons + 1)[1:]
+    total = np.bincount(polygon_labels, weights=values, minlength=n_polygons + 1)[1:]
+    
+    # Sort the values by polygon and then by value, so every polygon is a sorted slice
+    sorted_values = values[np.lexsort((values, polygon_labels))]
+    starts = np.cumsum(count) - count
+    
+    # Indices are only valid for polygons with pixels, the others are masked afterwards
+    has_pixels = count > 0
+    first = np.where(has_pixels, starts, 0)
+    last = np.where(has_pixels, starts + count - 1, 0)
+    median_low = np.where(has_pixels, starts + (count - 1) // 2, 0)
+    median_high = np.where(has_pixels, starts + count // 2, 0)
+    
+    if sorted_values.size == 0:
+        sorted_values = np.array([np.nan])
+    
+    return {
+        'count': count,
+        'min': np.where(has_pixels, sorted_values[first], np.nan),
+        'mean': np.where(has_pixels, total / np.maximum(count, 1), np.nan),
+        'max': np.where(has_pixels, sorted_values[last], np.nan),
+        'median': np.where(has_pixels, (sorted_values[median_low] + sorted_values[median_high]) / 2, np.nan),
+        }
 
 # Extract backscatter values from both Sentinel images
-def retrieve_stats(raster, polygon, affine, stats_lst = ['count', 'min', 'mean', 'max', 'median']):
+def retrieve_stats(values, labels, n_polygons, stats_lst = ['count', 'min', 'mean', 'max', 'median']):
     """
     This function does the following things:
         1. Create a empty DataFrame
-        2. Enumerates over all sub-folders to retrieve SAR VV-backscatter images
-        3. Retrieve statistics using zonal_stats from rasterstats
+        2. Retrieve statistics of every polygon using the pixel labels
+        3. Take the statistic of the polygon statistics (e.g., minimum of minimum values)
         
     Inputs
-    - 'raster' are the SAR images (as Numpy array) used for retrieving zonal statistics
-    - 'polygon' are the polygons used for overlaying on top of the SAR data
-    - 'affine' is required to georeference the Numpz array
+    - 'values' are the SAR values (as Numpy array) of the polygon pixels used for retrieving zonal statistics
+    - 'labels' are the polygon labels of these pixels, created with vector_pixel_index()
+    - 'n_polygons' is the number of polygons in the vector set
     - 'stats_lst' are the statistics one wants to retrieve. NOTE this should not be changed in the current code as it will lead to errors
     """
     
@@ -71,64 +150,31 @@ def retrieve_stats(raster, polygon, affine, stats_lst = ['count', 'min', 'mean',
     df_stats = pd.DataFrame(index = np.arange(1), columns = stats_lst)
     
     # Retrieve all the zonal statistics first
-    stats =  zonal_stats(polygon, raster, affine = affine, stats = stats_lst)
+    stat_map = polygon_stats(values, labels, n_polygons)
     
-    # Define empty dictionary for appending values
-    stat_map = {}
-
-    # Retrieve single value for each individual statistics
-    # and save into the dataframe
-    for i, stat in enumerate(stats_lst):
-        # Index to specific statistic (e.g., 'count', 'min')
-        stat_curr = stats_lst[i]
+    # Take statistic of statistic values (e.g., max of max)
+    # Use the total pixel count for the count column
+    # np.nan* functions warn for polygons sets without any pixels, these simply result in NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
         
-        # First get the desired statistic from the dictionary within the list
-        # Then append the list of values into a map
-        # And then retake the same statistic (e.g., minimum of minimum values, mean of the mean values)
-        # Return into DataFrame
-        specific_stat_lst = [d[stat_curr] for d in stats]
-        # Preprocess the list by replacing None values with NaN
-        processed_list = [value if value is not None else np.nan for value in specific_stat_lst]
-
-        # Convert the processed list to a NumPy array
-        my_array = np.array(processed_list)
-        
-        stat_map[stat_curr] = my_array
-
-        # Take statistic of statistic values (e.g., max of max)
-        if i == 0:   # Count column
-            pass
-        elif i == 1: # Minmum column
-            df_stats[stat_curr] = round(np.nanmin(stat_map[stat_curr]), 2)
-        elif i == 2: # Mean column
-            df_stats[stat_curr] = round(np.nanmean(stat_map[stat_curr]), 2)
-        elif i == 3: # Maximum column
-            df_stats[stat_curr] = round(np.nanmax(stat_map[stat_curr]), 2)
-        elif i == 4: # Median column
-            df_stats[stat_curr] = round(np.nanmedian(stat_map[stat_curr]), 2)
+        df_stats['count'] = int(np.sum(stat_map['count']))
+        df_stats['min'] = round(np.nanmin(stat_map['min']), 2) if np.any(stat_map['count']) else np.nan
+        df_stats['mean'] = round(np.nanmean(stat_map['mean']), 2)
+        df_stats['max'] = round(np.nanmax(stat_map['max']), 2) if np.any(stat_map['count']) else np.nan
+        df_stats['median'] = round(np.nanmedian(stat_map['median']), 2)
 
     return df_stats
- 
-def retrieve_zonal_statistics(vector, vector_name: str):
+
+def list_sar_images(rootdir, polarisation = "VH"):
     """
     This function does the following things:
-        1. Through a for-loop load each individual SAR image from Sentinel-1
-        2. Using a defined statistics list retrieve minimum, mean, maximum, and median backscatter values (dB)
-        3. With tune fcntion "retrieve_stats" extract statistics based on vector set (either ANLB or BRP)
-        4. Append statistics into a list and repeat the loop until all SAR statsitics are extracted
-    
-    Inputs
-        - 'Vector' should be the desired polygons to retrieve the zonal statistics from
-        - 'Vector_name' should be the string to use for printing to know the current progress
+        1. Loop over the dated sub-folders of the Sentinel-1 directory
+        2. Only take every other folder to guarantee we only take central overpasses
+        3. Return the filepaths of the backscatter images for the given polarisation
+    """
+    image_filepaths = []
     
-    """ 
-    # Define empty list to merge dataframes later on
-    df_lst, df_combined = [], []
-
-    # Define data folder
-    # NOTE: we take the original SAR images to cover backscatter values in the BRP parcels as well
-    rootdir = "../data/S1"  # Specify the directory path here 
-
     # Loop over the entire dir
     for i, item in enumerate(sorted(os.listdir(rootdir))):
         # Make sure we only take folders and not individual files (e.g., shapefiles)
@@ -141,165 +187,392 @@ def retrieve_zonal_statistics(vector, vector_name: str):
             # we can index for the desired .tif files
             for filename in os.listdir(item_path):
                 # Index for files named "Sigma0_dB_VV_20210104.tif", and ignore "Sigma0_dB_VH_20210104_quicklook.tif"
-                if filename.endswith(".tif") and "VH" in filename and not ("Coherence" in filename or "quicklook" in filename):
-                    print(f"Working on image: {filename} with {vector_name}")
-                    
-                    file_path = os.path.join(item_path, filename)
-                    
-                    # Reset the statistics dataframe for each image
-                    df_stats = []
-                    
-                    # Load in the rasters as Numpy array
-                    # Get transformation to georeference the array with the ANLB data
-                    sar_img, transform_img = load_raster(file_path)
-                    
-                    # Define statistics we want to retrieve
-                    stats_lst = ['count', 'min', 'mean', 'max', 'median']
-                    
-                    # Perform zonal statistics
-                    df_stats = retrieve_stats(sar_img, vector, transform_img, stats_lst)
+                if filename.endswith(".tif") and polarisation in filename and not ("Coherence" in filename or "quicklook" in filename):
+                    image_filepaths.append(os.path.join(item_path, filename))
                     
-                    # Split the entire name ("Sigma0_dB_VV_20210128.tif") to only keep "20210128"
-                    date = filename.split('_')[-1].split('.')[0].strip()
-                    
-                    # Add date into new column
-                    df_stats['date'] = date
-                    
-                    # Convert 'date' column to datetime
-                    df_stats['date'] = pd.to_datetime(df_stats['date'])
-                    
-                    # Append the DataFrame to the list
-                    df_lst.append(df_stats)
+    return image_filepaths
+ 
+# Folder containing the cached statistics of every (image, vector set, statistics) combination
+cache_folder = "../output/03_zonal_statistics_cache"
+
+def vector_digest(vector):
+    """
+    This function does the following things:
+        1. Hash the CRS and the geometries (as WKB) of a vector set
+        2. Return the hexadecimal digest, which changes as soon as any of the geometries changes
+    """
+    digest = hashlib.sha1(str(vector.crs).encode())
+    
+    for geom in vector.geometry:
+        digest.update(geom.wkb if geom is not None else b'')
+        
+    return digest.hexdigest()
+
+def cache_filepath(file_path, digest, stats_lst):
+    """
+    This function does the following things:
+        1. Fingerprint the SAR image using its absolute path, modification time and size
+        2. Combine this with the geometry digest of the vector set and the statistics list
+        3. Return the filepath of the cache entry for this combination
+    """
+    file_stat = os.stat(file_path)
+    fingerprint = f"{os.path.abspath(file_path)}|{file_stat.st_mtime_ns}|{file_stat.st_size}|{digest}|{','.join(stats_lst)}"
+    
+    return os.path.join(cache_folder, hashlib.sha1(fingerprint.encode()).hexdigest() + ".json")
+
+def read_cached_stats(filepath):
+    """ 
+    This function returns the cached statistics as dictionary, or None if the entry does not exist (yet)
+    """
+    if not os.path.exists(filepath):
+        return None
+    
+    with open(filepath) as f:
+        return json.load(f)
+
+def write_cached_stats(filepath, df_stats):
+    """
+    This function writes the statistics row to the cache. The file is written under a temporary name first
+    so processes running in parallel never read a partially written entry
+    """
+    os.makedirs(cache_folder, exist_ok=True)
+    
+    # NaN is not valid JSON, therefore store it as None
+    stats = {}
+    for stat in df_stats.columns:
+        value = df_stats[stat].iloc[0]
+        stats[stat] = None if pd.isnull(value) else value.item() if hasattr(value, 'item') else value
+    
+    tmp_filepath = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_filepath, 'w') as f:
+        json.dump(stats, f)
+    os.replace(tmp_filepath, filepath)
+
+# Vector sets, geometry digests and pixel index of the current (worker) process
+# Set by init_worker() so the vector sets are only sent once to every worker
+worker_vector_sets = {}
+worker_digests = {}
+worker_pixel_index = {}
+
+def init_worker(vector_sets, pixel_index=None):
+    """
+    This function does the following things:
+        1. Store the vector sets and their geometry digests in the current process
+        2. Store the pixel index computed once by the parent process (keyed on the grid), so the workers do not
+           index the vector sets themselves. Only an image on another grid is indexed again by the process handling it
+    """
+    worker_vector_sets.clear()
+    worker_vector_sets.update(vector_sets)
+    worker_digests.clear()
+    worker_digests.update({vector_name: vector_digest(vector) for vector_name, vector in vector_sets.items()})
+    worker_pixel_index.clear()
+    worker_pixel_index.update(pixel_index or {})
+
+def image_statistics(file_path, stats_lst = ['count', 'min', 'mean', 'max', 'median']):
+    """
+    This function does the following things:
+        1. Look up the statistics of every vector set in the cache
+        2. Open the SAR image (one acquisition date) only if any vector set is not cached yet
+        3. Index the pixels of the vector sets of this process, only if the grid differs from the previous image
+        4. Read the pixels of all missing vector sets in a single pass, only the strips of the image containing them
+        5. Retrieve the statistics of the missing vector sets and add them to the cache
+        
+    Returns a dictionary with the vector name as key and the statistics row (as DataFrame) as value
+    """
+    filename = os.path.basename(file_path)
+    
+    # Take the date from the name ("Sigma0_dB_VV_20210128.tif")
+    date = pd.Timestamp(parse_sar_date(filename))
+    
+    df_stats_map = {}
+    missing = {}
+    
+    for vector_name in worker_vector_sets:
+        filepath = cache_filepath(file_path, worker_digests[vector_name], stats_lst)
+        stats = read_cached_stats(filepath)
+        
+        if stats is None:
+            missing[vector_name] = filepath
+        else:
+            df_stats_map[vector_name] = pd.DataFrame([stats], columns = stats_lst).astype(
+                {stat: float for stat in stats_lst if stat != 'count'})
+    
+    if missing:
+        print(f"Working on image: {filename} with {', '.join(missing)}")
+        
+        with rasterio.open(file_path, driver='GTiff') as src:
+            # Only index the vector sets again if the grid differs from the previous image
+            grid = (src.shape, src.transform)
+            if grid not in worker_pixel_index:
+                worker_pixel_index.clear()
+                worker_pixel_index[grid] = vector_pixel_index(worker_vector_sets, src.shape, src.transform)
+            pixel_index = worker_pixel_index[grid]
+            
+            # The pixels of all missing vector sets, every pixel is read only once
+            image_pixels = np.unique(np.concatenate([pixel_index[vector_name][0] for vector_name in missing]))
+            image_values = read_pixels(src, image_pixels)
+        
+        for vector_name, filepath in missing.items():
+            vector_pixels, labels = pixel_index[vector_name]
+            values = image_values[np.searchsorted(image_pixels, vector_pixels)]
+            
+            # Perform zonal statistics
+            df_stats = retrieve_stats(values, labels, len(worker_vector_sets[vector_name]), stats_lst)
+            write_cached_stats(filepath, df_stats)
+            
+            df_stats_map[vector_name] = df_stats
+    else:
+        print(f"Using cached statistics for image: {filename}")
             
+    for df_stats in df_stats_map.values():
+        # Add date into new column
+        df_stats['date'] = date
             
-    # Merge dataframes together
-    # Concatenate the dataframes and assign new index names
-    df_combined = pd.concat(df_lst)
+    return df_stats_map
+ 
+def retrieve_zonal_statistics(vector_sets, n_workers = 1):
+    """
+    This function does the following things:
+        1. Load each individual SAR image from Sentinel-1 only once, either in a for-loop or in a pool of processes
+        2. Every image (acquisition date) is handled by image_statistics(), which retrieves the minimum, mean, maximum, 
+           and median backscatter values (dB) for every vector set
+        3. Append statistics into a list per vector set in date order, until all SAR statsitics are extracted
+    
+    Inputs
+        - 'vector_sets' should be a dictionary with the name of the vector set (used for printing to know the current progress)
+          as key and the desired polygons to retrieve the zonal statistics from as value
+        - 'n_workers' is the number of processes used, 1 processes all images in the current process
+    
+    Returns a dictionary with the same keys and the statistics DataFrame of each vector set as value
+    """ 
+    # Define data folder
+    # NOTE: we take the original SAR images to cover backscatter values in the BRP parcels as well
+    rootdir = "../data/S1"  # Specify the directory path here 
+    
+    image_filepaths = list_sar_images(rootdir, "VH")
+    
+    # Index the pixels of the vector sets only once, on the grid of the first image (all images share it)
+    pixel_index = {}
+    if image_filepaths:
+        with rasterio.open(image_filepaths[0]) as src:
+            pixel_index[(src.shape, src.transform)] = vector_pixel_index(vector_sets, src.shape, src.transform)
+    
+    if n_workers > 1:
+        # Every worker receives the vector sets and the (sparse) pixel index once and then handles one acquisition date at a time
+        # map() returns the results in the same (date) order as the images
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(vector_sets, pixel_index)) as executor:
+            results = list(executor.map(image_statistics, image_filepaths))
+    else:
+        init_worker(vector_sets, pixel_index)
+        results = [image_statistics(file_path) for file_path in image_filepaths]
+            
+    df_combined = {}
+    
+    for vector_name in vector_sets:
+        # Merge dataframes together
+        # Concatenate the dataframes and assign new index names
+        df = pd.concat([df_stats_map[vector_name] for df_stats_map in results])
+        
+        # Find the minimum date in the column
+        min_date = pd.to_datetime(pd.Series('2021-01-01'))
+        
+        # Calculate the number of days passed since the 1st of January
+        df['days_since_jan1'] = (df['date'] - min_date[0]).dt.days + 1
+        
+        df_combined[vector_name] = df
     
-    # Find the minimum date in the column
-    min_date = pd.to_datetime(pd.Series('2021-01-01'))
+    return df_combined
+
+def retrieve_zonal_statistics_from_store(vector_sets, store_folder, stats_lst = ['count', 'min', 'mean', 'max', 'median']):
+    """
+    This function does the following things:
+        1. Open the parcel-pixel store written by s02, which only contains the pixels of the parcels
+        2. Label the store pixels of every vector set once
+        3. Retrieve the statistics of every vector set per date directly from the memory-mapped values
+    
+    Inputs
+        - 'vector_sets' same as for retrieve_zonal_statistics()
+        - 'store_folder' is the folder of the parcel-pixel store (see parcel_pixel_store.py)
     
-    # Calculate the number of days passed since the 1st of January
-    df_combined['days_since_jan1'] = (df_combined['date'] - min_date).dt.days + 1
+    NOTE: the store only contains the (central pass) images and parcels clipped by s02, pixels of a vector set 
+    outside of these parcels are not included in the statistics
+    
+    Returns a dictionary with the same keys and the statistics DataFrame of each vector set as value
+    """
+    store = open_store(store_folder)
+    
+    # Store pixels and their labels per vector set, a pixel of overlapping polygons is listed once per polygon
+    store_labels = {vector_name: pixel_labels(store, vector.to_crs(store['crs'])) for vector_name, vector in vector_sets.items()}
+
+    df_combined = {}
+    
+    for vector_name, vector in vector_sets.items():
+        print(f"Working on {vector_name} from {store_folder}")
+        df_lst = []
+        
+        for t, date in enumerate(store['dates']):
+            store_pixels, labels = store_labels[vector_name]
+            
+            # Nodata pixels are stored as 999
+            values = store['values'][t][store_pixels]
+            values = np.where(values == store['nodata'], np.nan, values)
+            
+            df_stats = retrieve_stats(values, labels, len(vector), stats_lst)
+            df_stats['date'] = pd.to_datetime(date)
+            df_lst.append(df_stats)
+        
+        df = pd.concat(df_lst)
+        
+        # Calculate the number of days passed since the 1st of January
+        df['days_since_jan1'] = (df['date'] - pd.Timestamp('2021-01-01')).dt.days + 1
+        
+        df_combined[vector_name] = df
     
     return df_combined
 
-# %% Retrieve zonal statistics for the ANLB and BNRP data
-# Assign filenames for checking if the .csv exists, and for creating a new one if needed
-filename_anlb = "../output/03_anlb_statistics.csv"
-filename_brp = "../output/03_brp_statistics.csv"
-
-# Check if the ANLB statistics file already exists
-if os.path.exists(filename_anlb):
-    df_anlb = pd.read_csv(filename_anlb)
-    print("The file already exists.")
-else:
-    df_anlb = retrieve_zonal_statistics(gdf_anlb, "ANLB")
+def main(n_workers = 1, source = 'tiff', datasets = None):
+    """
+    This function does the following things:
+        1. Read in the ANLB-subsidy and BRP data, or take them from the datasets shared with the other stages
+           (see shared_datasets.py) when the pipeline runs in a single process
+        2. Retrieve zonal statistics of the ANLB, BRP and representative pixels (only for images not cached yet),
+           or from the parcel-pixel store written by s02 when 'source' is 'store'
+        3. Create and save the time-series figure
+    """
+    # First load in the ANLB-subsidy and BRP data
+    gdf_anlb = get_dataset(datasets, "../data/01_ANLB_filtered.shp", read_vector)
+    gdf_brp_clip = get_dataset(datasets, "../output/01_brp_grassland_sample_1000.shp", read_vector)
+    
+    # Define the vector sets
+    # Assign filenames for saving the statistics
+    filename_anlb = "../output/03_anlb_statistics.csv"
+    filename_brp = "../output/03_brp_statistics.csv"
+
+    # Define the extent of five representative pixels as a single list
+    extent_lst = [
+        [5.4898417317950887, 53.1597811149882418, 5.4903768596555151, 53.1599419888393143], #1 - Friesland
+        [5.5106949090941608, 53.1475020995522840, 5.5108963654507210, 53.1476136227111553], #2 - Friesland
+        [5.0220660063737572, 52.4272351063809054, 5.0222749930232906, 52.4273773226332978], #3 - Noord-Holland
+        [4.9326604056431744, 51.9831009252632583, 4.9328957684955537, 51.9832394405185951], #4 - Utrecht
+        [5.7714493650383663, 51.9296325083013386, 5.7716859400861100, 51.9297904830481514]  #5 - Gelderland
+        ]
+
+    # Convert the representative pixels to GeoDataFrame
+    vector_sets = {f"Representative pixel #{i}": create_vector(extent).to_crs('EPSG:32631') for i, extent in enumerate(extent_lst)}
+    vector_sets["ANLB"] = gdf_anlb
+    vector_sets["BRP"] = gdf_brp_clip
+
+    # Retrieve zonal statistics for all vector sets in a single pass over the SAR images
+    # Statistics are cached per image, so only new or changed images are processed
+    if source == 'store':
+        df_zonal = retrieve_zonal_statistics_from_store(vector_sets, "../output/02_VH_parcel_pixels")
+    else:
+        df_zonal = retrieve_zonal_statistics(vector_sets, n_workers)
+
+    df_anlb = df_zonal["ANLB"]
     df_anlb.to_csv(filename_anlb, index=False)
 
-# Repeat for the BRP data
-if os.path.exists(filename_brp):
-    df_brp = pd.read_csv(filename_brp)
-    print("The file already exists.")
-else:
-    df_brp = retrieve_zonal_statistics(gdf_brp_clip, "BRP")
+    df_brp = df_zonal["BRP"]
     df_brp.to_csv(filename_brp, index=False)
 
 
-# %% Plot time-series graph
+    # Plot time-series graph
 
-fig, ax = plt.subplots(figsize = (12, 8))
+    fig, ax = plt.subplots(figsize = (12, 8))
 
-""" ANLB DATA """
-# Plot the mean value retrieved from the ANLB polygons
-anlb_col = '#219ebc'
+    """ ANLB DATA """
+    # Plot the mean value retrieved from the ANLB polygons
+    anlb_col = '#219ebc'
 
-sns.lineplot(x='days_since_jan1', y='mean', data=df_anlb, 
-             color = anlb_col, label=r'$\mu$ of ANLB ($\mathit{N}$ = 481 obj)', linestyle = '--')
+    sns.lineplot(x='days_since_jan1', y='mean', data=df_anlb, 
+                 color = anlb_col, label=r'$\mu$ of ANLB ($\mathit{N}$ = 481 obj)', linestyle = '--')
 
-# Shade the area in-between using the minimum and maximum backscatter values
-anlb_min = df_anlb['min']
-anlb_max = df_anlb['max']
+    # Shade the area in-between using the minimum and maximum backscatter values
+    anlb_min = df_anlb['min']
+    anlb_max = df_anlb['max']
 
-""" BRP DATA """
-brp_col = '#fb8500'
+    """ BRP DATA """
+    brp_col = '#fb8500'
 
-# Create simple line plot
-sns.lineplot(x='days_since_jan1', y='mean', data=df_brp, 
-             color = brp_col, label='$\mu$ of BRP ($\mathit{n}$ = 1000 obj)', linestyle = '--')
+    # Create simple line plot
+    sns.lineplot(x='days_since_jan1', y='mean', data=df_brp, 
+                 color = brp_col, label='$\mu$ of BRP ($\mathit{n}$ = 1000 obj)', linestyle = '--')
 
-# Shade the area in-between using the minimum and maximum backscatter values
-brp_min = df_brp['min']
-brp_max = df_brp['max']
+    # Shade the area in-between using the minimum and maximum backscatter values
+    brp_min = df_brp['min']
+    brp_max = df_brp['max']
 
 
-""" SELECTED PIXELS """
-pix_col = '#780000'
+    """ SELECTED PIXELS """
+    pix_col = '#780000'
 
-# But also for newly created pixels to get accurate pixel-level statistics
-# Define the extent coordinates as a single list
-extent_lst = [
-    [5.4898417317950887, 53.1597811149882418, 5.4903768596555151, 53.1599419888393143], #1 - Friesland
-    [5.5106949090941608, 53.1475020995522840, 5.5108963654507210, 53.1476136227111553], #2 - Friesland
-    [5.0220660063737572, 52.4272351063809054, 5.0222749930232906, 52.4273773226332978], #3 - Noord-Holland
-    [4.9326604056431744, 51.9831009252632583, 4.9328957684955537, 51.9832394405185951], #4 - Utrecht
-    [5.7714493650383663, 51.9296325083013386, 5.7716859400861100, 51.9297904830481514]  #5 - Gelderland
-    ]
+    # Plot the statistics of the representative pixels as line graph
+    for i in range(len(extent_lst)):
+        df_pix = df_zonal[f"Representative pixel #{i}"]
 
-# Loop through the extent list
-# Convert to GeoDataFrame
-# Extract statistics
-# And plot as line graph
-for i, extent in enumerate(extent_lst):
-    gdf_pix = create_vector(extent).to_crs('EPSG:32631')
-    
-    df_pix = retrieve_zonal_statistics(gdf_pix, f"Representative pixel #{i}")
-    
-    line = sns.lineplot(x='days_since_jan1', y='mean', data=df_pix, 
-                        color = pix_col, linestyle = ':', alpha=0.5,
-                        label='Representative pixels in ANLb-parcel ($\mathit{n}$ = 5)' if i < 2 else None)
+        line = sns.lineplot(x='days_since_jan1', y='mean', data=df_pix, 
+                            color = pix_col, linestyle = ':', alpha=0.5,
+                            label='Representative pixels in ANLb-parcel ($\mathit{n}$ = 5)' if i < 2 else None)
 
 
-""" MIN-MAX FILLS"""
-plt.fill_between(df_anlb['days_since_jan1'], anlb_min, anlb_max, 
-                color = anlb_col, alpha=0.2, label= "Min-Max of ANLb")
-ax.fill_between(df_brp['days_since_jan1'], brp_min, brp_max, 
-                color = brp_col, alpha=0.2, label='Min-Max of BRP')
+    """ MIN-MAX FILLS"""
+    plt.fill_between(df_anlb['days_since_jan1'], anlb_min, anlb_max, 
+                    color = anlb_col, alpha=0.2, label= "Min-Max of ANLb")
+    ax.fill_between(df_brp['days_since_jan1'], brp_min, brp_max, 
+                    color = brp_col, alpha=0.2, label='Min-Max of BRP')
 
-# remove margin spaces
-plt.margins(0, 0)
+    # remove margin spaces
+    plt.margins(0, 0)
 
-# add label to the axis and label to the plot
-ax.set(xlabel ="Day of the year", 
-       ylabel = "VH-backscatter [dB]")#,
+    # add label to the axis and label to the plot
+    ax.set(xlabel ="Day of the year", 
+           ylabel = "VH-backscatter [dB]")#,
 
-ax.set_title("Temporal variations of backscatter in different parcels", fontsize=16)
+    ax.set_title("Temporal variations of backscatter in different parcels", fontsize=16)
 
-# Despine the plot
-sns.despine(top=True, right=True, left=True, bottom=True)
+    # Despine the plot
+    sns.despine(top=True, right=True, left=True, bottom=True)
 
-# Add grid lines
-ax.grid(color='gray', linestyle='--', linewidth=0.5)
-ax.grid(True)
+    # Add grid lines
+    ax.grid(color='gray', linestyle='--', linewidth=0.5)
+    ax.grid(True)
 
-# Move the legend below the plot
-ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.1), ncol=3)
+    # Move the legend below the plot
+    ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.1), ncol=3)
+
+    # Create two vertical lines indicating the 15th of February up to the 15th of June 
+    # Corresponding to subsidy code 3C
+    x_ticks = [43, 165]
+    for x in x_ticks:
+        ax.axvline(x=x, color='red', linestyle='--')
+
+    # Calculate the midpoint between the two X-tick positions
+    midpoint = sum(x_ticks) / len(x_ticks)
+
+    # Add text at the midpoint
+    ax.text(midpoint, ax.get_ylim()[1] * 0.5, "Inundation Period (3c)", ha='center', fontsize=14)
 
-# Create two vertical lines indicating the 15th of February up to the 15th of June 
-# Corresponding to subsidy code 3C
-x_ticks = [43, 165]
-for x in x_ticks:
-    ax.axvline(x=x, color='red', linestyle='--')
-    
-# Calculate the midpoint between the two X-tick positions
-midpoint = sum(x_ticks) / len(x_ticks)
 
-# Add text at the midpoint
-ax.text(midpoint, ax.get_ylim()[1] * 0.5, "Inundation Period (3c)", ha='center', fontsize=14)
+    plt.tight_layout()
+    #plt.show()
 
+    # Save the figure
+    plt.savefig("../output/03_timeseries_backscatter.png")
+    
+    # Close the figure, the process might continue with other stages of the pipeline
+    plt.close(fig)
 
-plt.tight_layout()
-#plt.show()
 
-# Save the figure
-plt.savefig("../output/03_timeseries_backscatter.png")
+if __name__ == "__main__":
+    # create the parser
+    parser = argparse.ArgumentParser(description='Zonal statistics of the SAR time-series')
+    
+    # add the argument
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used to handle the SAR images. Defaults to 1')
+    parser.add_argument('--source', choices=['tiff', 'store'], default='tiff',
+                        help="Read the original SAR images ('tiff') or the parcel-pixel store written by s02 ('store'). Defaults to 'tiff'")
+    
+    # parse the arguments
+    args = parser.parse_args()
+    
+    main(args.workers, args.source)
@@ -1,38 +1,57 @@
 import rasterio
 import glob
 import os
+from contextlib import ExitStack
+
+from compositing import composite_ranges, composites
+from raster_io import output_profile, build_overviews
+
+output_folder = "../data/thresholding_data/output/averages"
+nodata_value = 999
+
+# Non-overlapping pairs (1+2, 3+4, ...), an odd last image is paired with the previous one
+window = 2
+stride = 2
+reducer = "mean"
+
 
 def calc_image_average():
     # To run the script for VV-polarization, change the line below to
     # image_filepaths = sorted(glob.glob(f"../data/thresholding_data/training/vvsar/*.tif"))
     image_filepaths = sorted(glob.glob(f"../data/thresholding_data/training/vhsar/*.tif"))
 
-    for i in range(0, len(image_filepaths) - 1, 2):
-        with rasterio.open(image_filepaths[i]) as src1, rasterio.open(image_filepaths[min(i + 1, len(image_filepaths) - 1)]) as src2:
-            image1 = src1.read(1)
-            image2 = src2.read(1)
-            average_image = (image1 + image2) / 2
-                
-            profile = src1.profile
-            avg_output_filepath = os.path.join(f"../data/thresholding_data/output/averages", f'average_{i//2 + 1}.tif')
-            os.makedirs(os.path.dirname(avg_output_filepath), exist_ok=True)
-                
-            with rasterio.open(avg_output_filepath, 'w', **profile) as dst:
-                dst.write(average_image, 1)
-
-    # Special case for the last image, paired with the previous one
-    if len(image_filepaths) % 2 != 0:
-        with rasterio.open(image_filepaths[-2]) as src1, rasterio.open(image_filepaths[-1]) as src2:
-            image1 = src1.read(1)
-            image2 = src2.read(1)
-            average_image = (image1 + image2) / 2
-                
-            profile = src1.profile
-            avg_output_filepath = os.path.join(f"../data/thresholding_data/output/averages", f'average_{len(image_filepaths)//2 + 1}.tif')
-            os.makedirs(os.path.dirname(avg_output_filepath), exist_ok=True)
-                
-            with rasterio.open(avg_output_filepath, 'w', **profile) as dst:
-                dst.write(average_image, 1)
-
-
-calc_image_average()
\ No newline at end of file
+    n_averages = len(composite_ranges(len(image_filepaths), window, stride, include_tail=True))
+    if n_averages == 0:
+        return
+
+    os.makedirs(output_folder, exist_ok=True)
+
+    with ExitStack() as stack:
+        sources = [stack.enter_context(rasterio.open(fp)) for fp in image_filepaths]
+        for src in sources:
+            if src.shape != sources[0].shape:
+                raise ValueError(f"{src.name} does not have the same shape as {sources[0].name}")
+
+        profile = output_profile(sources[0].profile)
+        outputs = [stack.enter_context(rasterio.open(os.path.join(output_folder, f'average_{n}.tif'), 'w', **profile))
+                   for n in range(1, n_averages + 1)]
+
+        # Stream the images block by block, so only a few blocks are held in memory instead of the full scenes.
+        # The blocks follow the tiles of the (compressed) outputs, so every tile is written exactly once
+        for _, block in outputs[0].block_windows(1):
+            blocks = (src.read(1, window=block) for src in sources)
+            averages = composites(blocks, window, stride, reducer, nodata_value, include_tail=True)
+            for dst, (_, average_block) in zip(outputs, averages):
+                dst.write(average_block, 1, window=block)
+
+        for dst in outputs:
+            build_overviews(dst)
+
+
+def main(datasets=None):
+    # The averages are only computed from rasters, so there are no datasets to share with the other stages
+    calc_image_average()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,144 +1,268 @@
-import os
-
-import rasterio
-import geopandas as gpd
-import numpy as np
-from rasterio.mask import mask
-
-from scipy.optimize import fsolve
-
-from sklearn.model_selection import train_test_split
-from sklearn.linear_model import LogisticRegression
-from sklearn.metrics import accuracy_score
-
-
-np.random.seed(42)
-
-
-
-filename_brp_sample ="../output/01_brp_grassland_sample_1000.shp" 
-
-
-fp_waterpoly = "../data/training_data"
-
-sar_images_vv = "../data/thresholding_data/output/averages"
-
-# Mapping of average_X.tif files to corresponding WaterYYYYMMDD.shp files
-mapping_dict = {
-    'average_1.tif': 'Water20210226.shp',
-    'average_2.tif': 'Water20210331.shp',
-    'average_3.tif': 'Water20210427.shp',
-    'average_4.tif': 'Water20210530.shp',
-    'average_5.tif': 'Water20210616.shp'
-}
-
-
-def sigmoid(x):
-        return 1 / (1 + np.exp(-x))
-
-
-
-def extract_raster_value(vector, ds):
-    shapes = [feature.__geo_interface__ for feature in vector.geometry]
-    masked_image, masked_transform = mask(dataset=ds, shapes=shapes, crop=True, nodata = np.nan)
-    raster_values = masked_image[0]
-    raster_values_flat = raster_values.flatten()
-    # Exclude values that are equal to np.nan
-    raster_values_flat = raster_values_flat[~np.isnan(raster_values_flat)]
-    return raster_values_flat
-
-def load_raster(ds):
-    return ds.read(1)
-
-
-def get_threshold(water, sar, brp, threshold):
-    gdf_waterpoly = gpd.read_file(water).set_crs('EPSG:28992').to_crs('EPSG:32631')
-    gdf_brp = gpd.read_file(brp)
-    sar_vv_ds = rasterio.open(sar)
-    sar_vv = load_raster(sar_vv_ds)
-    mask1 = np.isnan(sar_vv)
-    arr_water_vv = extract_raster_value(gdf_waterpoly, sar_vv_ds)
-    arr_brp_vv = extract_raster_value(gdf_brp, sar_vv_ds)
-
-    # print(f"Total BRP Pixels {len(arr_brp_vv)}")
-
-    # Calculate min and max of the image data
-    min_val = np.nanmin(sar_vv)
-    max_val = np.nanmax(sar_vv)
-
-
-    # Take random subset of arr_brp_vv with length equal to arr_water_vv
-    if len(arr_brp_vv) > len(arr_water_vv):
-        arr_brp_vv = np.random.choice(arr_brp_vv, len(arr_water_vv), replace=False)
-
-    # print(f"Total Water Pixels {len(arr_water_vv)}")
-    # print(f"Total BRP Pixels (random sub samples) {len(arr_brp_vv)}")
-
-    sar_vv_ds.close()
-
-    labels_water = np.ones(len(arr_water_vv))
-    labels_brp = np.zeros(len(arr_brp_vv))
-
-    features = np.concatenate((arr_water_vv, arr_brp_vv))
-    labels = np.concatenate((labels_water, labels_brp))
-
-    # Split the data into train and test sets
-    X_train, X_test, y_train, y_test = train_test_split(features.reshape(-1, 1), labels, test_size=0.2, random_state=42)
-
-    model = LogisticRegression(random_state=42)
-    model.fit(X_train, y_train.ravel())
-
-    # Predict the labels of the test set
-    y_pred = model.predict(X_test)
-
-    # Calculate the accuracy of the model
-    accuracy = accuracy_score(y_test, y_pred)
-    print("Accuracy:", accuracy)
-
-    def decision_function(x, model=model):
-        if x < min_val or x > max_val:
-            return np.inf
-        return sigmoid(x * model.coef_[0] + model.intercept_[0]) - threshold
-
-
-    initial_guess = -19
-    try:
-        threshold = fsolve(decision_function, initial_guess)
-    except RuntimeError:
-        print("Failed to find threshold for current data")
-        threshold = [np.nan]
-
-    print("Threshold for classification:", threshold[0])
-    # Return both threshold and pixel count
-    return threshold[0], len(arr_water_vv)
-
-
-def average_threshold(threshold=0.7):
-
-    all_thresholds = []
-    all_pixel_counts = []
-
-    for sar, water in mapping_dict.items():
-        sar_path = os.path.join(sar_images_vv, sar)
-        water_path = os.path.join(fp_waterpoly, water)
-
-        if os.path.isfile(sar_path) and os.path.isfile(water_path):
-            print(f'Processing: {sar}')
-            threshold, pixel_count = get_threshold(water_path, sar_path, filename_brp_sample, threshold)
-            all_thresholds.append(threshold)
-            all_pixel_counts.append(pixel_count)
-        else:
-            print(f'Skipping: {sar} (No corresponding files found)')
-
-    # Convert lists to numpy arrays for calculation
-    all_thresholds = np.array(all_thresholds)
-    all_pixel_counts = np.array(all_pixel_counts)
-
-    # Calculate weighted average threshold
-    average_threshold = np.average(all_thresholds, weights=all_pixel_counts)
-
-    print(f"Average Threshold Value: {average_threshold}")
-    return average_threshold
-
-
-
+import os
+import glob
+import json
+import hashlib
+import threading
+import argparse
+
+import rasterio
+import geopandas as gpd
+import numpy as np
+from rasterio.mask import mask
+
+from scipy.optimize import fsolve
+
+from sklearn.model_selection import train_test_split
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import accuracy_score
+
+from shared_datasets import get_dataset
+from vector_cache import read_vector, vector_loader
+
+# Seed of the BRP pixel subsample, every fit uses its own generator so the (cached) thresholds do not
+# depend on which other stages or fits used random numbers before
+random_seed = 42
+
+
+filename_brp_sample ="../output/01_brp_grassland_sample_1000.shp" 
+
+
+fp_waterpoly = "../data/training_data"
+
+sar_images_vv = "../data/thresholding_data/output/averages"
+
+# Fitted thresholds, keyed on the probability level and the fingerprints of the input files
+threshold_cache_fp = "../output/04b_threshold_cache.json"
+threshold_memo = {}
+
+# Mapping of average_X.tif files to corresponding WaterYYYYMMDD.shp files
+mapping_dict = {
+    'average_1.tif': 'Water20210226.shp',
+    'average_2.tif': 'Water20210331.shp',
+    'average_3.tif': 'Water20210427.shp',
+    'average_4.tif': 'Water20210530.shp',
+    'average_5.tif': 'Water20210616.shp'
+}
+
+
+def sigmoid(x):
+        return 1 / (1 + np.exp(-x))
+
+
+
+def extract_raster_value(vector, ds):
+    shapes = [feature.__geo_interface__ for feature in vector.geometry]
+    masked_image, masked_transform = mask(dataset=ds, shapes=shapes, crop=True, nodata = np.nan)
+    raster_values = masked_image[0]
+    raster_values_flat = raster_values.flatten()
+    # Exclude values that are equal to np.nan
+    raster_values_flat = raster_values_flat[~np.isnan(raster_values_flat)]
+    return raster_values_flat
+
+def load_raster(ds):
+    return ds.read(1)
+
+
+def fit_model(water, sar, brp, datasets=None):
+    gdf_waterpoly = get_dataset(datasets, water, vector_loader(source_crs='EPSG:28992'))
+    gdf_brp = get_dataset(datasets, brp, read_vector)
+    sar_vv_ds = rasterio.open(sar)
+    sar_vv = load_raster(sar_vv_ds)
+    mask1 = np.isnan(sar_vv)
+    arr_water_vv = extract_raster_value(gdf_waterpoly, sar_vv_ds)
+    arr_brp_vv = extract_raster_value(gdf_brp, sar_vv_ds)
+
+    # print(f"Total BRP Pixels {len(arr_brp_vv)}")
+
+    # Calculate min and max of the image data
+    min_val = np.nanmin(sar_vv)
+    max_val = np.nanmax(sar_vv)
+
+
+    # Take random subset of arr_brp_vv with length equal to arr_water_vv
+    if len(arr_brp_vv) > len(arr_water_vv):
+        rng = np.random.default_rng(random_seed)
+        arr_brp_vv = rng.choice(arr_brp_vv, len(arr_water_vv), replace=False)
+
+    # print(f"Total Water Pixels {len(arr_water_vv)}")
+    # print(f"Total BRP Pixels (random sub samples) {len(arr_brp_vv)}")
+
+    sar_vv_ds.close()
+
+    labels_water = np.ones(len(arr_water_vv))
+    labels_brp = np.zeros(len(arr_brp_vv))
+
+    features = np.concatenate((arr_water_vv, arr_brp_vv))
+    labels = np.concatenate((labels_water, labels_brp))
+
+    # Split the data into train and test sets
+    X_train, X_test, y_train, y_test = train_test_split(features.reshape(-1, 1), labels, test_size=0.2, random_state=42)
+
+    model = LogisticRegression(random_state=42)
+    model.fit(X_train, y_train.ravel())
+
+    # Predict the labels of the test set
+    y_pred = model.predict(X_test)
+
+    # Calculate the accuracy of the model
+    accuracy = accuracy_score(y_test, y_pred)
+    print("Accuracy:", accuracy)
+
+    # Return the model together with the value range of the image (the bounds of the threshold) and the pixel count
+    return model, min_val, max_val, len(arr_water_vv)
+
+
+def solve_threshold(model, min_val, max_val, threshold):
+    # Backscatter value at which the fitted model gives the probability level 'threshold'
+    def decision_function(x, model=model):
+        if x < min_val or x > max_val:
+            return np.inf
+        return sigmoid(x * model.coef_[0] + model.intercept_[0]) - threshold
+
+
+    initial_guess = -19
+    try:
+        threshold = fsolve(decision_function, initial_guess)
+    except RuntimeError:
+        print("Failed to find threshold for current data")
+        threshold = [np.nan]
+
+    print("Threshold for classification:", threshold[0])
+    return threshold[0]
+
+
+def get_threshold(water, sar, brp, threshold, datasets=None):
+    model, min_val, max_val, pixel_count = fit_model(water, sar, brp, datasets)
+    # Return both threshold and pixel count
+    return solve_threshold(model, min_val, max_val, threshold), pixel_count
+
+
+def file_fingerprint(filepath):
+    # A shapefile consists of multiple files with the same name, all of them are included
+    filepaths = sorted(glob.glob(os.path.splitext(filepath)[0] + ".*")) if filepath.endswith(".shp") else [filepath]
+
+    fingerprint = []
+    for fp in filepaths:
+        file_stat = os.stat(fp)
+        fingerprint.append([os.path.abspath(fp), file_stat.st_mtime_ns, file_stat.st_size])
+    return fingerprint
+
+
+def threshold_cache_key(threshold):
+    # Key on the probability level, the subsample seed and the fingerprints of all inputs of the logistic regressions
+    inputs = [threshold, ["default_rng", random_seed], file_fingerprint(filename_brp_sample)]
+
+    for sar, water in mapping_dict.items():
+        sar_path = os.path.join(sar_images_vv, sar)
+        water_path = os.path.join(fp_waterpoly, water)
+
+        if os.path.isfile(sar_path) and os.path.isfile(water_path):
+            inputs.append([file_fingerprint(sar_path), file_fingerprint(water_path)])
+
+    return hashlib.sha1(json.dumps(inputs).encode()).hexdigest()
+
+
+def load_threshold_cache():
+    if not os.path.exists(threshold_cache_fp):
+        return {}
+
+    with open(threshold_cache_fp) as f:
+        return json.load(f)
+
+
+def save_threshold_cache(entries):
+    # Reload the cache first, another stage might have added an entry in the meantime
+    cache = load_threshold_cache()
+    cache.update(entries)
+
+    os.makedirs(os.path.dirname(threshold_cache_fp), exist_ok=True)
+    # Unique per process and thread, so concurrent writers never share a temporary file
+    tmp_filepath = f"{threshold_cache_fp}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_filepath, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_filepath, threshold_cache_fp)
+
+
+def average_threshold(threshold=0.7, datasets=None):
+    return thresholds_for([threshold], datasets)[0]
+
+
+def thresholds_for(probabilities, datasets=None):
+    # Reuse the thresholds fitted earlier for the same probability level and unchanged inputs,
+    # either in this process or in an earlier run (stored in the cache file)
+    keys = [threshold_cache_key(probability) for probability in probabilities]
+    missing = {key: probability for key, probability in zip(keys, probabilities) if key not in threshold_memo}
+
+    if missing:
+        cache = load_threshold_cache()
+        to_fit = {key: probability for key, probability in missing.items() if key not in cache}
+
+        if len(to_fit) < len(missing):
+            print(f"Using cached thresholds from {threshold_cache_fp}")
+
+        # The missing probability levels are all solved from a single fit per image
+        if to_fit:
+            fitted = dict(zip(to_fit, fit_thresholds(list(to_fit.values()), datasets)))
+            cache.update(fitted)
+            save_threshold_cache(fitted)
+
+        for key in missing:
+            threshold_memo[key] = cache[key]
+
+    averages = []
+    for key in keys:
+        entry = threshold_memo[key]
+        for sar, image_entry in entry['images'].items():
+            print(f"Threshold for {sar}: {image_entry['threshold']} ({image_entry['pixel_count']} water pixels)")
+
+        print(f"Average Threshold Value: {entry['average_threshold']}")
+        averages.append(entry['average_threshold'])
+    return averages
+
+
+def fit_thresholds(probabilities=(0.7,), datasets=None):
+    # Fit the logistic regression of every image once and solve the threshold of every probability level from it
+    images = {probability: {} for probability in probabilities}
+
+    for sar, water in mapping_dict.items():
+        sar_path = os.path.join(sar_images_vv, sar)
+        water_path = os.path.join(fp_waterpoly, water)
+
+        if os.path.isfile(sar_path) and os.path.isfile(water_path):
+            print(f'Processing: {sar}')
+            model, min_val, max_val, pixel_count = fit_model(water_path, sar_path, filename_brp_sample, datasets)
+            for probability in probabilities:
+                image_threshold = solve_threshold(model, min_val, max_val, probability)
+                images[probability][sar] = {'threshold': float(image_threshold), 'pixel_count': int(pixel_count)}
+        else:
+            print(f'Skipping: {sar} (No corresponding files found)')
+
+    entries = []
+    for probability in probabilities:
+        # Convert lists to numpy arrays for calculation
+        all_thresholds = np.array([image['threshold'] for image in images[probability].values()])
+        all_pixel_counts = np.array([image['pixel_count'] for image in images[probability].values()])
+
+        # Calculate weighted average threshold
+        average_threshold = np.average(all_thresholds, weights=all_pixel_counts)
+
+        entries.append({'probability': probability, 'images': images[probability], 'average_threshold': float(average_threshold)})
+    return entries
+
+
+def main(threshold_value=0.7, datasets=None):
+    # Fit the thresholds once before s04c and s04d run, these then take them from the cache
+    average_threshold(threshold_value, datasets)
+
+
+if __name__ == "__main__":
+    # create the parser
+    parser = argparse.ArgumentParser(description='Threshold value of the logistic regressions')
+
+    # add the argument
+    parser.add_argument('--threshold_value', type=float, default=0.7, help='Probability level of the threshold. Defaults to 0.7')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    main(args.threshold_value)
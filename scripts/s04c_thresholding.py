@@ -10,26 +10,32 @@ from datetime import datetime
 from s04b_get_threshold_value import average_threshold
 from rasterio.io import MemoryFile
 
-import argparse
-
-# create the parser
-parser = argparse.ArgumentParser(description='Puddles')
-
-# add the argument
-parser.add_argument('--threshold_value', type=float, help='Threshold value. Defaults to 0.5 if nothing is provided')
+from shared_datasets import get_dataset
+from vector_cache import read_vector
+from parcel_pixel_store import open_store, pixel_labels
+from parcel_labels import rasterize_layers
+from sar_cube import parse_sar_date, open_cube, date_range
+from compositing import composite_ranges, composites
+from raster_io import BINARY_NODATA, classify_binary, write_binary, write_raster
 
-# parse the arguments
-args = parser.parse_args()
+import argparse
 
 output_path = '../output'
 # To run the script for VV-polarization, change the line below to ***image_folder = '../data/02_VV_mp_clipped'****
 image_folder = '../output/02_VH_mp_clipped'
+# Parcel-pixel store written by s02, used instead of image_folder with --source store
+store_folder = '../output/02_VH_parcel_pixels'
+# Time-series cube written by s02b (the default source), change the polarisation to 'VV' for VV-polarization
+cube_folder = '../output'
+cube_polarisation = 'VH'
 shapefile_path = '../output/01_subsidised_field.shp'
+# Running average of every two consecutive images (1+2, 2+3, ...), see compositing.py for other composites
+window = 2
+stride = 1
+reducer = 'mean'
 
 
 
-    
-
 def calculate_inundation(thresholded_image, id):
     # Replace nan values with 1
     img = np.nan_to_num(thresholded_image, nan=1)
@@ -48,16 +54,51 @@ def calculate_inundation(thresholded_image, id):
         return inundation_percentage
 
 
-def calculate_inundation_all_images(image_folder, shapefile_filepath, output_folder, threshold):
-    image_filepaths = sorted(glob.glob(f"{image_folder}/*.tif"))
-    gdf = gpd.read_file(shapefile_filepath)
-    nodata_value = 999  # Define your NoData value
+def rasterize_parcels(gdf, out_shape, transform):
+    # Burn the positional index of every parcel (starting at 1) into label rasters, 0 is left for pixels
+    # outside of all parcels. Overlapping parcels are burned into separate layers, so each keeps all of its pixels
+    return rasterize_layers(gdf.geometry.values, out_shape, transform)
+
+
+def parcel_pixel_index(label_layers):
+    # Flat index and label of the pixels within a parcel, so the counts per date only touch these pixels.
+    # A pixel shared by overlapping parcels is listed once for every parcel
+    parcel_pixels = [np.flatnonzero(labels) for labels in label_layers]
+    parcel_labels = [labels.ravel()[pixels] for labels, pixels in zip(label_layers, parcel_pixels)]
+
+    parcel_pixels = np.concatenate([np.zeros(0, dtype='int64')] + parcel_pixels)
+    parcel_labels = np.concatenate([np.zeros(0, dtype='int32')] + parcel_labels)
+    return parcel_pixels, parcel_labels
+
 
-    # Create an empty dataframe for binary values
-    df = pd.DataFrame()
+def count_inundated_pixels(binary_image, parcel_pixels, parcel_labels, n_parcels):
+    # Nodata pixels within a parcel are counted as inundated, same as calculate_inundation()
+    inundated = binary_image.ravel()[parcel_pixels] != 0
+    return np.bincount(parcel_labels[inundated], minlength=n_parcels + 1)[1:]
 
-    # Create a separate dataframe for parcel-level inundation percentages
-    parcel_df = pd.DataFrame()
+
+def calculate_inundation_all_images(image_folder, shapefile_filepath, output_folder, threshold, threshold_value, parcel_mode='label', datasets=None, source='tiff', packbits=False):
+    # With source 'cube', image_folder is the folder of the time-series cube of s02b instead of the clipped images.
+    # With source 'store', it is the folder of the parcel-pixel store. The images are then 1D arrays of only the
+    # parcel pixels, so no running average or binary images are written
+    if source == 'cube':
+        cube = open_cube(image_folder, cube_polarisation)
+        image_dates = [str(date).replace("-", "") for date in cube['dates']]
+    elif source == 'store':
+        if parcel_mode != 'label':
+            raise ValueError("The parcel-pixel store can only be used with parcel_mode 'label'")
+
+        store = open_store(image_folder)
+        image_dates = store['dates']
+    else:
+        image_filepaths = sorted(glob.glob(f"{image_folder}/*.tif"))
+        image_dates = [parse_sar_date(image).strftime("%Y%m%d") for image in image_filepaths]
+
+    gdf = get_dataset(datasets, shapefile_filepath, read_vector)
+    nodata_value = 999  # Define your NoData value
+
+    # Pixels and labels of the parcels, only built once since all clipped images share the same grid
+    parcel_pixels = None
 
     category_dates = {
         "3a": (2, 15, 4, 15),
@@ -74,108 +115,184 @@ def calculate_inundation_all_images(image_folder, shapefile_filepath, output_fol
         month=category_dates["3d"][2], day=category_dates["3d"][3]
     ).date()
 
-    image_filepaths = [
-    image for image in image_filepaths if datetime.strptime(
-        os.path.basename(image).split('_')[4], "%Y%m%d"
-    ).date() >= datetime.now().replace(
-        month=category_dates["3d"][0], day=category_dates["3d"][1], year=2021
-    ).date() and datetime.strptime(
-        os.path.basename(image).split('_')[4], "%Y%m%d"
-    ).date() <= datetime.now().replace(
-        month=category_dates["3d"][2], day=category_dates["3d"][3], year=2021
-    ).date()
-    ]
-
-    # print(len(image_filepaths))
-
-    # Iterate over all the images, excluding the last one
-    for i in range(len(image_filepaths) - 1):
-        with rasterio.open(image_filepaths[i]) as src1, rasterio.open(image_filepaths[i + 1]) as src2:
-            image1 = src1.read(1)
-            image2 = src2.read(1)
-            
-
-            # Convert nodata values to np.nan
-            image_one = np.where(image1 == nodata_value, np.nan, image1)
-            image_two = np.where(image2 == nodata_value, np.nan, image2)
-
-            # Compute the average while ignoring np.nan values
-            average_image = np.nanmean([image_one, image_two], axis=0)
-
-
-            # Get the date of the second image
-            # date_str = os.path.basename(image_filepaths[i + 1]).split('_')[3].split('.')[0]
-            date_str = os.path.basename(image_filepaths[i + 1]).split('_')[4]
-
-            date = datetime.strptime(date_str, "%Y%m%d")
-
-            profile = src1.profile
-
+    # Positions of the images within the date range, the dates of the cube are sorted so these are a slice
+    if source == 'cube':
+        time_slice = date_range(cube, datetime(2021, *category_dates["3d"][:2]), datetime(2021, *category_dates["3d"][2:]))
+        image_positions = list(range(len(image_dates)))[time_slice]
+    else:
+        image_positions = [
+            k for k, image_date in enumerate(image_dates) if datetime.strptime(
+                image_date, "%Y%m%d"
+            ).date() >= datetime.now().replace(
+                month=category_dates["3d"][0], day=category_dates["3d"][1], year=2021
+            ).date() and datetime.strptime(
+                image_date, "%Y%m%d"
+            ).date() <= datetime.now().replace(
+                month=category_dates["3d"][2], day=category_dates["3d"][3], year=2021
+            ).date()
+        ]
+
+    # print(len(image_positions))
+
+    # Preallocate the results as a (parcels x dates) array, the dataframes are only assembled at the end
+    n_dates = len(composite_ranges(len(image_positions), window, stride))
+    inundation = np.full((len(gdf), n_dates), np.nan)
+    column_names = []
+
+    # Inundation period of every parcel, encoded as month * 100 + day for vectorized date comparisons
+    parcel_periods = np.array([category_dates[code] for code in gdf["CODE_BEHEE"]]).reshape(-1, 4)
+    period_start = parcel_periods[:, 0] * 100 + parcel_periods[:, 1]
+    period_end = parcel_periods[:, 2] * 100 + parcel_periods[:, 3]
+
+    # All clipped images share the same grid, so the profile of the first image is used for all outputs
+    if source == 'store':
+        gdf = gdf.to_crs(store['crs'])
+    elif source == 'cube':
+        average_profile = dict(driver='GTiff', dtype='float32', count=1, width=cube['width'], height=cube['height'],
+                               crs=cube['crs'], transform=cube['transform'], nodata=np.nan)
+        # Binary images are uint8, 1 inundated, 0 dry and BINARY_NODATA for pixels without backscatter
+        binary_profile = dict(average_profile, dtype='uint8', nodata=BINARY_NODATA)
+        transform = cube['transform']
+        gdf = gdf.to_crs(cube['crs'])
+
+        os.makedirs(f"{output_folder}/running_average", exist_ok=True)
+    elif image_positions:
+        with rasterio.open(image_filepaths[image_positions[0]]) as src:
+            average_profile = dict(src.profile, dtype='float32')
+            # Binary images are uint8, 1 inundated, 0 dry and BINARY_NODATA for pixels without backscatter
+            binary_profile = dict(src.profile, dtype='uint8', nodata=BINARY_NODATA)
+            transform = src.transform
+            gdf = gdf.to_crs(src.crs)
+
+        os.makedirs(f"{output_folder}/running_average", exist_ok=True)
+
+    # Reused for every date
+    binary_image = None
+
+    def read_images():
+        # Every image is read once, the compositing keeps it while it is part of the window
+        if source == 'cube':
+            # The scenes of the date range are a slice of the memory-mapped cube
+            yield from cube['values'][time_slice]
+            return
+
+        for position in image_positions:
+            if source == 'store':
+                yield store['values'][position]
+            else:
+                with rasterio.open(image_filepaths[position]) as src:
+                    yield src.read(1)
+
+    # Iterate over the running averages, nodata values (999) are ignored
+    for i, ((_, stop), average_image) in enumerate(composites(read_images(), window, stride, reducer, nodata_value, reuse_output=True)):
+
+        # Get the date of the last image of the average
+        date_str = image_dates[image_positions[stop - 1]]
+
+        date = datetime.strptime(date_str, "%Y%m%d")
+
+        # Convert the average image to binary, in place: 1 at or below the threshold, 0 above it
+        binary_image = classify_binary(average_image, threshold, out=binary_image)
+
+        if source != 'store':
             # Save the average image
             avg_output_filepath = os.path.join(f"{output_folder}/running_average", f'running_average_{i + 1}.tif')
-            os.makedirs(os.path.dirname(avg_output_filepath), exist_ok=True)
-            with rasterio.open(avg_output_filepath, 'w', **profile) as dst:
-                dst.write(average_image, 1)
-
-            # Convert the average image to binary
-            binary_image = average_image.copy()
-            binary_image[binary_image > threshold] = 0
-            binary_image[binary_image <= threshold] = 1
-
-            
+            write_raster(avg_output_filepath, average_image, average_profile)
 
             # Save the binary image
             binary_output_filepath = os.path.join(f"{output_folder}/binary", f'binary_{i + 1}.tif')
-            os.makedirs(os.path.dirname(binary_output_filepath), exist_ok=True)
-            with rasterio.open(binary_output_filepath, 'w', **profile) as dst:
-                dst.write(binary_image, 1)
-
-            gdf = gdf.to_crs(src1.crs)
+            write_binary(binary_output_filepath, binary_image, binary_profile, packbits)
+
+        # Select the parcels for which this date lies within their inundation period
+        month_day = date.month * 100 + date.day
+        in_period = (period_start <= month_day) & (month_day <= period_end)
+
+        # Update column names with second date
+        column_names.append(f'{date.date()}')
+
+        if parcel_mode == 'label':
+            if parcel_pixels is None:
+                if source == 'store':
+                    # The images are the store values, so the parcel pixels are positions in the store
+                    parcel_pixels, parcel_labels = pixel_labels(store, gdf)
+                else:
+                    parcel_pixels, parcel_labels = parcel_pixel_index(rasterize_parcels(gdf, binary_image.shape, transform))
+                total_counts = np.bincount(parcel_labels, minlength=len(gdf) + 1)[1:]
+
+            # Pixel counts of all parcels for this date in a single pass
+            inundated_counts = count_inundated_pixels(binary_image, parcel_pixels, parcel_labels, len(gdf))
+
+            # Skip parcels that do not cover the centre of any pixel
+            valid = in_period & (total_counts > 0)
+            inundation[valid, i] = inundated_counts[valid] / total_counts[valid] * 100
+        else:
+            # Write the binary_image array to a temporary rasterio dataset once, and clip it for every parcel
+            with MemoryFile() as memfile:
+                with memfile.open(**binary_profile) as dataset:
+                    dataset.write(binary_image, 1)
+
+                    for pos in np.flatnonzero(in_period):
+                        row = gdf.iloc[pos]
+                        parcel_binary_image, _ = rasterio.mask.mask(dataset, [row['geometry']], crop=True, nodata=BINARY_NODATA)
+
+                        if parcel_binary_image.size == 0:
+                            continue
+
+                        # Nodata is NaN for calculate_inundation()
+                        parcel_binary_image = np.where(parcel_binary_image == BINARY_NODATA, np.nan, parcel_binary_image)
+                        inundation[pos, i] = calculate_inundation(parcel_binary_image, int(row['OBJECTID']))
+
+    # Only keep the parcels and dates for which at least one value was computed
+    rows = ~np.all(np.isnan(inundation), axis=1)
+    cols = ~np.all(np.isnan(inundation), axis=0)
+    inundation = inundation[rows][:, cols]
+    column_names = [name for name, keep in zip(column_names, cols) if keep]
+    object_ids = gdf['OBJECTID'].to_numpy()[rows].astype(int)
+
+    # Parcels are flagged as inundated (1) when more than 60% of their pixels are inundated
+    binary = np.where(np.isnan(inundation), np.nan, (inundation > 60).astype(float))
+    percentage = np.round(inundation)
+
+    df = pd.DataFrame(binary, columns=column_names)
+    df.insert(0, 'OBJECTID', object_ids)
+
+    parcel_df = pd.DataFrame(percentage, columns=column_names)
+    parcel_df.insert(0, 'OBJECTID', object_ids)
 
-            for idx, row in gdf.iterrows():
-                start_month, start_day, end_month, end_day = category_dates[row["CODE_BEHEE"]]
-                start_date = datetime(date.year, start_month, start_day)
-                end_date = datetime(date.year, end_month, end_day)
-
-                if start_date <= date <= end_date:
-                    # Write the binary_image array to a temporary rasterio dataset
-                    with MemoryFile() as memfile:
-                        with memfile.open(**profile) as dataset:
-                            dataset.write(binary_image, 1)
-                            # Now you can pass the dataset (which is a DatasetWriter object) to the mask function
-                            parcel_binary_image, _ = rasterio.mask.mask(dataset, [row['geometry']], crop=True, nodata=np.nan)
-
-                    if parcel_binary_image.size == 0:
-                        continue
-
-                    inundation_percentage = calculate_inundation(parcel_binary_image, int(row['OBJECTID']))
-
-
-                    # Update column names in parcel_df with second date
-                    column_name = f'{date.date()}'
+    # Save binary dataframe to CSV and Excel files
+    df.to_csv(f'{output_folder}/{threshold_value}-output.csv', index=False)
+    df.to_excel(f'{output_folder}/{threshold_value}-output.xlsx', index=False)
 
-                    df.loc[idx, 'OBJECTID'] = int(row['OBJECTID']) 
-                    # if math.isnan(row['fieldid']) else int(row['fieldid'])
-                    df.loc[idx, column_name] = 1 if inundation_percentage > 60 else 0
+    # Save parcel-level inundation percentages to separate CSV and Excel files
+    parcel_df.to_csv(f'{output_folder}/{threshold_value}-parcel_inundation.csv', index=False)
+    parcel_df.to_excel(f'{output_folder}/{threshold_value}-parcel_inundation.xlsx', index=False)
 
-                   
-                    parcel_df.loc[idx, 'OBJECTID'] = int((row['OBJECTID'])) 
-                    # if math.isnan(row['fieldid']) else int(row['fieldid'])
-                    parcel_df.loc[idx, column_name] = int(round(inundation_percentage))
 
 
 
-    # Save binary dataframe to CSV and Excel files
-    df.to_csv(f'{output_folder}/{args.threshold_value}-output.csv', index=False)
-    df.to_excel(f'{output_folder}/{args.threshold_value}-output.xlsx', index=False)
 
-    # Save parcel-level inundation percentages to separate CSV and Excel files
-    parcel_df.to_csv(f'{output_folder}/{args.threshold_value}-parcel_inundation.csv', index=False)
-    parcel_df.to_excel(f'{output_folder}/{args.threshold_value}-parcel_inundation.xlsx', index=False)
+def main(threshold_value=None, parcel_mode='label', source='cube', packbits=False, datasets=None):
+    threshold = average_threshold(threshold_value, datasets)
+    folder = {'cube': cube_folder, 'store': store_folder}.get(source, image_folder)
+    calculate_inundation_all_images(folder, shapefile_path, output_path, threshold, threshold_value, parcel_mode, datasets, source, packbits)
 
 
+if __name__ == "__main__":
+    # create the parser
+    parser = argparse.ArgumentParser(description='Puddles')
 
+    # add the argument
+    parser.add_argument('--threshold_value', type=float, help='Threshold value. Defaults to 0.5 if nothing is provided')
+    parser.add_argument('--parcel_mode', choices=['label', 'mask'], default='label',
+                        help="'label' rasterizes the parcels once and counts all parcels in one pass, "
+                             "'mask' clips the binary image per parcel. Defaults to 'label'")
+    parser.add_argument('--source', choices=['cube', 'tiff', 'store'], default='cube',
+                        help="Read the time-series cube written by s02b ('cube'), the clipped images ('tiff') "
+                             "or the parcel-pixel store written by s02 ('store'). Defaults to 'cube'")
+    parser.add_argument('--packbits', action='store_true',
+                        help='Also save every binary image as bit-packed NumPy file (binary_N.bits.npz)')
 
+    # parse the arguments
+    args = parser.parse_args()
 
-threshold_value = average_threshold(args.threshold_value)
-calculate_inundation_all_images(image_folder, shapefile_path, output_path, threshold_value)
+    main(args.threshold_value, args.parcel_mode, args.source, args.packbits)
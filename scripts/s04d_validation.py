@@ -15,21 +15,12 @@ from sklearn.linear_model import LogisticRegression
 import json
 from shapely.geometry import mapping
 from sklearn.metrics import accuracy_score
-from s04b_get_threshold_value import average_threshold
+from s04b_get_threshold_value import average_threshold, thresholds_for, random_seed
+from shared_datasets import get_dataset
+from vector_cache import read_vector, vector_loader
+from raster_io import classify_binary, write_binary
 import argparse
 
-# create the parser
-parser = argparse.ArgumentParser(description='Puddles')
-
-# add the argument
-parser.add_argument('--threshold_value', type=float, help='Threshold value. Defaults to 0.5 if nothing is provided')
-
-# parse the arguments
-args = parser.parse_args()
-
-# # access the argument
-# print(args.threshold_value)
-
 filename_brp_sample = "../output/01_brp_grassland_sample_1000.shp"
 fp_waterpoly = '../data/training_data'
 sar_images_vv = "../data/thresholding_data/output/averages"
@@ -58,16 +49,16 @@ def extract_raster_value(vector, ds):
     raster_values_flat = raster_values_flat[~np.isnan(raster_values_flat)]
     return raster_values_flat
 
-def get_pixels(water, sar, brp):
-    gdf_waterpoly = gpd.read_file(water).set_crs('EPSG:28992').to_crs('EPSG:32631')
-    gdf_brp = gpd.read_file(brp)
+def get_pixels(water, sar, brp, datasets=None):
+    gdf_waterpoly = get_dataset(datasets, water, vector_loader(source_crs='EPSG:28992'))
+    gdf_brp = get_dataset(datasets, brp, read_vector)
     sar_vv_ds = rasterio.open(sar)
-    sar_vv = load_raster(sar_vv_ds)
     arr_water_vv = extract_raster_value(gdf_waterpoly, sar_vv_ds)
     arr_brp_vv = extract_raster_value(gdf_brp, sar_vv_ds)
 
     if len(arr_brp_vv) > len(arr_water_vv):
-        arr_brp_vv = np.random.choice(arr_brp_vv, len(arr_water_vv), replace=False)
+        rng = np.random.default_rng(random_seed)
+        arr_brp_vv = rng.choice(arr_brp_vv, len(arr_water_vv), replace=False)
 
     print(f"Total Water Pixels {len(arr_water_vv)}")
     print(f"Total BRP Pixels (random sub samples) {len(arr_brp_vv)}")
@@ -76,82 +67,186 @@ def get_pixels(water, sar, brp):
 
     return arr_water_vv, arr_brp_vv
 
-def binary_and_confusion():
-    threshold_value = average_threshold(threshold=args.threshold_value)
-    actual_labels = []
-    predicted_labels = []
+def confusion_counts(water_predicted, grass_predicted):
+    # Count the classified pixels at the ground truth (water) and BRP (grass) locations,
+    # both given as boolean arrays which are True where the pixel is classified as water
+    water_predicted = np.asarray(water_predicted, dtype=bool)
+    grass_predicted = np.asarray(grass_predicted, dtype=bool)
+
+    TP = int(np.count_nonzero(water_predicted))
+    FP = int(np.count_nonzero(grass_predicted))
+    return {'TP': TP, 'FP': FP, 'TN': grass_predicted.size - FP, 'FN': water_predicted.size - TP}
+
+def confusion_metrics(counts):
+    TP, FP, TN, FN = counts['TP'], counts['FP'], counts['TN'], counts['FN']
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.float64(TP) / (TP + FP)
+        recall = np.float64(TP) / (TP + FN)
+        accuracy = np.float64(TP + TN) / (TP + FP + FN + TN)
+
+    return {'Precision': precision, 'Recall': recall, 'Accuracy': accuracy}
+
+def save_binary_image(sar, threshold_value, binary_output_filepath, packbits=False):
+    # Classify the whole image and save it, pixels at or below the threshold are water (1)
+    with rasterio.open(sar) as src:
+        binary_image = classify_binary(src.read(1), threshold_value, nodata=src.nodata)
+        profile = src.profile
+
+    write_binary(binary_output_filepath, binary_image, profile, packbits)
+
+def binary_and_confusion(probability=None, save_binary=False, datasets=None, packbits=False):
+    threshold_value = average_threshold(threshold=probability, datasets=datasets)
     image_counter = 1
 
+    # The confusion matrix is accumulated per image, next to the counts of every image itself
+    total_counts = {'TP': 0, 'FP': 0, 'TN': 0, 'FN': 0}
+    image_rows = []
+
     for sar, water in mapping_dict.items():
+        sar_name = sar
         sar = os.path.join(sar_images_vv, sar)
         
         water = os.path.join(fp_waterpoly, water)
 
-        ground_truth_values, brp_values = get_pixels(water, sar, filename_brp_sample)
-        
-        with rasterio.open(sar) as src:
-            sar_data = src.read(1)
-            profile = src.profile
+        ground_truth_values, brp_values = get_pixels(water, sar, filename_brp_sample, datasets)
 
-        binary_image = sar_data.copy()
-        binary_image[sar_data > threshold_value] = 0
-        binary_image[sar_data <= threshold_value] = 1
+        # The binary images are only an optional side output, the pixel values at the ground truth
+        # and BRP locations are classified directly
+        if save_binary:
+            save_binary_image(sar, threshold_value, os.path.join(binary_images_vv, f'binary_{image_counter}.tif'), packbits)
+            print(f"on binary_{image_counter}.tif")
 
-        binary_output_filepath = os.path.join("../data/thresholding_data/output/binary", f'binary_{image_counter}.tif')
-        os.makedirs(os.path.dirname(binary_output_filepath), exist_ok=True)
-        with rasterio.open(binary_output_filepath, 'w', **profile) as dst:
-            dst.write(binary_image, 1)
+        # Pixels at or below the threshold are classified as water
+        counts = confusion_counts(ground_truth_values <= threshold_value, brp_values <= threshold_value)
+        for key, val in counts.items():
+            total_counts[key] += val
 
-        binary = os.path.join(binary_images_vv, f"binary_{image_counter}.tif")
+        metrics = confusion_metrics(counts)
+        print(f"{sar_name}: {counts}, Precision: {metrics['Precision']}, Recall: {metrics['Recall']}, Accuracy: {metrics['Accuracy']}")
+        image_rows.append({'Image': sar_name, **counts, **metrics})
 
-        print(f"on binary_{image_counter}.tif")
+        image_counter += 1
 
-        classified_water, classified_grass = get_pixels(water, binary, filename_brp_sample)
+    # Confusion matrix in the same layout as a crosstab of the actual and predicted labels
+    confusion_matrix = pd.DataFrame([[total_counts['TN'], total_counts['FP']],
+                                     [total_counts['FN'], total_counts['TP']]],
+                                    index=pd.Index(['grass', 'water'], name='Actual'),
+                                    columns=pd.Index(['grass', 'water'], name='Predicted'))
 
-        actual_labels.extend(['water']*len(ground_truth_values))
-        actual_labels.extend(['grass']*len(brp_values))
+    # Calculate precision, recall and accuracy
+    metrics = confusion_metrics(total_counts)
 
-        # These are the predicted labels for the ground truth and brp_values pixel locations
-        predicted_water_labels = ['water' if i == 1 else 'grass' for i in classified_water]
-        predicted_grass_labels = ['water' if i == 1 else 'grass' for i in classified_grass]
+    print(f"Precision: {metrics['Precision']}")
+    print(f"Recall: {metrics['Recall']}")
+    print(f"Overall accuracy: {metrics['Accuracy']}")
 
-        predicted_labels.extend(predicted_water_labels)
-        predicted_labels.extend(predicted_grass_labels)
+    # Save the confusion matrix to a CSV file
+    confusion_matrix.to_csv(f"../output/{probability}-confusion_matrix.csv")
 
-        image_counter += 1
+    # Save the metrics to the same CSV file
+    with open(f"../output/{probability}-confusion_matrix.csv", 'a') as f:
+        f.write("\n\nMetrics:\n")
+        for key, val in metrics.items():
+            f.write(f"{key},{val}\n")
 
-    # print(predicted_labels[-10:]) 
+    # Save the counts and metrics of every image separately
+    pd.DataFrame(image_rows).to_csv(f"../output/{probability}-confusion_matrix_per_image.csv", index=False)
+
+def sweep_confusion(water_values, grass_values, thresholds):
+    # Pixels at or below a threshold are classified as water, so the counts for all thresholds
+    # follow from the positions of the thresholds in the sorted pixel values
+    thresholds = np.asarray(thresholds, dtype=float)
+    TP = np.searchsorted(np.sort(water_values), thresholds, side='right')
+    FP = np.searchsorted(np.sort(grass_values), thresholds, side='right')
+    FN = len(water_values) - TP
+    TN = len(grass_values) - FP
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sweep_df = pd.DataFrame({
+            'Threshold': thresholds,
+            'TP': TP, 'FP': FP, 'TN': TN, 'FN': FN,
+            'Precision': TP / (TP + FP),
+            'Recall': TP / (TP + FN),
+            'Accuracy': (TP + TN) / (TP + FP + TN + FN),
+            'False positive rate': FP / (FP + TN),
+        })
+    return sweep_df
+
+def threshold_sweep(probabilities, step=0.1, datasets=None):
+    # Extract the ground truth and BRP pixel values only once for all thresholds
+    water_values, grass_values = [], []
 
-    predicted_labels.extend(['water', 'grass'])
-    # print(predicted_labels[-10:]) 
+    for sar, water in mapping_dict.items():
+        sar = os.path.join(sar_images_vv, sar)
+        water = os.path.join(fp_waterpoly, water)
 
-    confusion_matrix = pd.crosstab(pd.Series(actual_labels, name='Actual'),
-                                   pd.Series(predicted_labels, name='Predicted'))
+        ground_truth_values, brp_values = get_pixels(water, sar, filename_brp_sample, datasets)
+        water_values.append(ground_truth_values)
+        grass_values.append(brp_values)
 
-    # Calculate precision, recall and accuracy
-    TP = confusion_matrix.loc['water', 'water']
-    FP = confusion_matrix.loc['grass', 'water']
-    TN = confusion_matrix.loc['grass', 'grass']
-    FN = confusion_matrix.loc['water', 'grass']
+    water_values = np.concatenate(water_values)
+    grass_values = np.concatenate(grass_values)
 
-    precision = TP / (TP + FP)
-    recall = TP / (TP + FN)
-    accuracy = (TP + TN) / (TP + FP + FN + TN)
+    # Thresholds (dB) belonging to the probability levels, these are cached by s04b.
+    # The logistic regressions are fitted once per image for all levels
+    level_thresholds = thresholds_for(probabilities, datasets=datasets)
 
-    print(f"Precision: {precision}")
-    print(f"Recall: {recall}")
-    print(f"Overall accuracy: {accuracy}")
+    # Evenly spaced thresholds covering all pixel values, used for the curves
+    all_values = np.concatenate((water_values, grass_values))
+    grid_thresholds = np.arange(np.floor(all_values.min()), np.ceil(all_values.max()) + step, step)
 
-    # Store the metrics in a dictionary
-    metrics = {'Precision': precision, 'Recall': recall, 'Accuracy': accuracy}
+    levels_df = sweep_confusion(water_values, grass_values, level_thresholds)
+    levels_df.insert(0, 'Probability', probabilities)
 
-    # Save the confusion matrix to a CSV file
-    confusion_matrix.to_csv(f"../output/{args.threshold_value}-confusion_matrix.csv")
+    grid_df = sweep_confusion(water_values, grass_values, grid_thresholds)
+    grid_df.insert(0, 'Probability', np.nan)
 
-    # Save the metrics to the same CSV file
-    with open(f"../output/{args.threshold_value}-confusion_matrix.csv", 'a') as f:
-        f.write("\n\nMetrics:\n")
-        for key, val in metrics.items():
-            f.write(f"{key},{val}\n")
+    sweep_df = pd.concat([levels_df, grid_df], ignore_index=True)
+    sweep_df.to_csv("../output/sweep-confusion_matrix.csv", index=False)
+    print(levels_df.to_string(index=False))
+
+    # Plot the precision-recall and ROC curves, with the probability levels as points
+    fig, (ax_pr, ax_roc) = plt.subplots(1, 2, figsize=(12, 6))
+
+    ax_pr.plot(grid_df['Recall'], grid_df['Precision'], color='#219ebc')
+    ax_pr.scatter(levels_df['Recall'], levels_df['Precision'], color='#fb8500', zorder=3)
+    ax_pr.set(xlabel='Recall', ylabel='Precision', title='Precision-recall curve')
+
+    ax_roc.plot(grid_df['False positive rate'], grid_df['Recall'], color='#219ebc')
+    ax_roc.scatter(levels_df['False positive rate'], levels_df['Recall'], color='#fb8500', zorder=3)
+    ax_roc.plot([0, 1], [0, 1], color='gray', linestyle='--', linewidth=0.5)
+    ax_roc.set(xlabel='False positive rate', ylabel='True positive rate', title='ROC curve')
+
+    for _, row in levels_df.iterrows():
+        ax_pr.annotate(f"{row['Probability']}", (row['Recall'], row['Precision']))
+        ax_roc.annotate(f"{row['Probability']}", (row['False positive rate'], row['Recall']))
+
+    plt.tight_layout()
+    plt.savefig("../output/sweep-pr_roc_curve.png")
+    plt.close(fig)
+
+def main(threshold_value=None, sweep_values=None, save_binary=False, packbits=False, datasets=None):
+    if sweep_values:
+        threshold_sweep(sweep_values, datasets=datasets)
+    else:
+        binary_and_confusion(threshold_value, save_binary, datasets, packbits)
+
+
+if __name__ == "__main__":
+    # create the parser
+    parser = argparse.ArgumentParser(description='Puddles')
+
+    # add the argument
+    parser.add_argument('--threshold_value', type=float, help='Threshold value. Defaults to 0.5 if nothing is provided')
+    parser.add_argument('--sweep', type=float, nargs='+', 
+                        help='Evaluate multiple threshold values at once instead of a single one, e.g. --sweep 0.3 0.5 0.7')
+    parser.add_argument('--save_binary', action='store_true',
+                        help='Also save the classified (binary) images to ../data/thresholding_data/output/binary')
+    parser.add_argument('--packbits', action='store_true',
+                        help='With --save_binary, also save every binary image as bit-packed NumPy file (binary_N.bits.npz)')
+
+    # parse the arguments
+    args = parser.parse_args()
 
-binary_and_confusion()
\ No newline at end of file
+    main(args.threshold_value, args.sweep, args.save_binary, args.packbits)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Helper functions for the SAR time-series cubes built by s02b_build_sar_cube.py.
+
+A cube stacks all clipped scenes of one polarisation into a single (time, y, x) float32 array, stored as
+memory-mapped .npy file with a JSON sidecar holding the date of every scene and the grid:
+
+    02b_{polarisation}_cube.npy  : float32 (n_dates, height, width), nodata (999) is stored as NaN
+    02b_{polarisation}_cube.json : dates (YYYYMMDD), source filenames, crs, transform, width and height
+
+Scenes can then be selected by date range and pixel window by slicing, without opening the GeoTIFFs again.
+Composites of consecutive scenes are computed by passing such a slice to compositing.composites(), which holds
+only the scenes of one window in memory (see s04c_thresholding.py).
+The sidecar is written last, a cube without sidecar is incomplete and is not read.
+"""
+import os
+import re
+import json
+from datetime import datetime
+
+import numpy as np
+import rasterio
+
+
+def parse_sar_date(filepath):
+    """
+    Function returns the acquisition date of a SAR image from its filename, e.g. "Sigma0_dB_VV_20210128.tif"
+    or the clipped "02_Sigma0_dB_VV_20210128_mp_clip.tif".
+
+    Parameters
+    ----------
+    filepath : string
+        Filepath or filename of the SAR image.
+
+    Returns
+    -------
+    datetime of the acquisition date.
+
+    """
+    match = re.search(r"(?<!\d)(\d{8})(?!\d)", os.path.basename(filepath))
+    if match is None:
+        raise ValueError(f"No date (YYYYMMDD) found in {filepath}")
+
+    return datetime.strptime(match.group(1), "%Y%m%d")
+
+
+def cube_filepaths(cube_folder, polarisation):
+    return (os.path.join(cube_folder, f"02b_{polarisation}_cube.npy"),
+            os.path.join(cube_folder, f"02b_{polarisation}_cube.json"))
+
+
+def create_cube(cube_folder, polarisation, n_dates, height, width):
+    """
+    Function creates a new (incomplete) cube and returns the memory-mapped (n_dates, height, width) array to fill.
+    """
+    values_fp, meta_fp = cube_filepaths(cube_folder, polarisation)
+    os.makedirs(cube_folder, exist_ok=True)
+
+    # Remove the sidecar first, so the cube is incomplete until finish_cube() is called
+    if os.path.exists(meta_fp):
+        os.remove(meta_fp)
+
+    return np.lib.format.open_memmap(values_fp, mode='w+', dtype='float32', shape=(n_dates, height, width))
+
+
+def finish_cube(cube_folder, polarisation, values, dates, filenames, crs, transform):
+    """
+    Function flushes the values and writes the JSON sidecar, which marks the cube as complete.
+    """
+    values.flush()
+
+    meta = {"dates": [date.strftime("%Y%m%d") for date in dates], "filenames": list(filenames), "crs": str(crs),
+            "transform": list(transform)[:6], "width": int(values.shape[2]), "height": int(values.shape[1])}
+
+    _, meta_fp = cube_filepaths(cube_folder, polarisation)
+    with open(meta_fp + ".tmp", 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(meta_fp + ".tmp", meta_fp)
+
+
+def open_cube(cube_folder, polarisation):
+    """
+    Function opens a complete cube.
+
+    Parameters
+    ----------
+    cube_folder : string
+        Folder containing the cube.
+    polarisation : string
+        VV or VH.
+
+    Returns
+    -------
+    cube : dictionary with the metadata of the sidecar, the 'dates' as numpy datetime64 array, the 'transform'
+        as Affine and the memory-mapped 'values' (n_dates, height, width).
+
+    """
+    values_fp, meta_fp = cube_filepaths(cube_folder, polarisation)
+    if not os.path.exists(meta_fp):
+        raise FileNotFoundError(f"{meta_fp} does not exist. Please run script #2b")
+
+    with open(meta_fp) as f:
+        cube = json.load(f)
+
+    cube["dates"] = np.array([datetime.strptime(date, "%Y%m%d") for date in cube["dates"]], dtype='datetime64[D]')
+    cube["transform"] = rasterio.Affine(*cube["transform"])
+    cube["values"] = np.load(values_fp, mmap_mode='r')
+    return cube
+
+
+def date_range(cube, start, end):
+    """
+    Function returns the slice of the time axis of all scenes from start up to and including end.
+
+    Parameters
+    ----------
+    cube : dictionary
+        Cube opened with open_cube().
+    start, end : string or datetime
+        First and last date, e.g. "2021-02-15".
+
+    Returns
+    -------
+    slice of the time axis.
+
+    """
+    first = np.searchsorted(cube["dates"], np.datetime64(start, 'D'), side='left')
+    last = np.searchsorted(cube["dates"], np.datetime64(end, 'D'), side='right')
+    return slice(int(first), int(last))
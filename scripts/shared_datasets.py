@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Helper functions to share loaded datasets (GeoDataFrames, arrays) between the pipeline stages
+when they are executed in a single process by main.py.
+
+Every stage receives the same 'datasets' dictionary, in which datasets are stored under the
+(absolute) filepath they are read from or written to. When a stage is executed on its own,
+'datasets' is None and all data is simply read from disk.
+
+NOTE: shared datasets are used by multiple stages, so they should be treated as read-only
+"""
+import os
+
+
+def dataset_key(filepath):
+    """
+    Return the key of a filepath in the datasets dictionary, independent of the working directory.
+    """
+    return os.path.normcase(os.path.abspath(filepath))
+
+
+def get_dataset(datasets, filepath, loader):
+    """
+    Function returns the dataset stored under filepath. If no stage loaded or produced it yet, it is
+    read from disk using the loader and stored for the next stages.
+
+    Parameters
+    ----------
+    datasets : dict or None
+        Datasets shared between the stages. None reads the dataset from disk.
+    filepath : string
+        Filepath of the dataset.
+    loader : function
+        Function reading the dataset from the filepath, e.g. gpd.read_file.
+
+    Returns
+    -------
+    The loaded dataset.
+
+    """
+    if datasets is None:
+        return loader(filepath)
+
+    key = dataset_key(filepath)
+    if key not in datasets:
+        datasets[key] = loader(filepath)
+
+    return datasets[key]
+
+
+def put_dataset(datasets, filepath, data):
+    """
+    Function stores a dataset which was written to filepath, so the next stages do not have to read it again.
+
+    Parameters
+    ----------
+    datasets : dict or None
+        Datasets shared between the stages. Nothing is stored when None.
+    filepath : string
+        Filepath the dataset was written to.
+    data :
+        The dataset.
+
+    Returns
+    -------
+    None.
+
+    """
+    if datasets is not None:
+        datasets[dataset_key(filepath)] = data
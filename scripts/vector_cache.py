@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Helper functions to read the vector inputs of the pipeline stages (shapefiles) through a cache of
+GeoParquet files, which are already reprojected to EPSG:32631.
+
+The first read of a shapefile parses it, reprojects it and stores the result in 'cache_folder'. Every
+next read (by the same or another stage) loads the GeoParquet file instead, which is considerably faster
+than parsing and reprojecting the shapefile again. The GeoParquet files contain a bbox covering column,
+so reads can be limited to a bounding box without loading the other features.
+
+A cached file is invalidated when the modification time or size of one of the files of the shapefile
+(.shp, .dbf, .prj, ...) changes, it is then created again from the shapefile.
+"""
+import os
+import glob
+import json
+import hashlib
+import threading
+
+import geopandas as gpd
+
+cache_folder = "../output/vector_cache"
+
+
+def source_fingerprint(filepath):
+    """
+    Fingerprint a vector file as the modification time and size of all files belonging to it
+    (a shapefile consists of multiple files with the same name).
+    """
+    filepaths = sorted(glob.glob(glob.escape(os.path.splitext(filepath)[0]) + ".*")) if filepath.endswith(".shp") else [filepath]
+
+    fingerprint = []
+    for fp in filepaths:
+        file_stat = os.stat(fp)
+        fingerprint.append([os.path.basename(fp), file_stat.st_mtime_ns, file_stat.st_size])
+    return fingerprint
+
+
+def option_repr(value):
+    """
+    Return a JSON serializable representation of a read option, used to key the cache.
+    """
+    # Geometries (e.g. a bbox given as GeoSeries) are keyed on their coordinates and coordinate reference system
+    if isinstance(value, (gpd.GeoSeries, gpd.GeoDataFrame)):
+        return [str(value.crs), value.geometry.to_wkt().tolist()]
+    return str(value)
+
+
+def cache_filepath(filepath, crs, source_crs, read_kwargs):
+    """
+    Return the filepath of the cached GeoParquet file of a vector file, read with the given options.
+    """
+    options = [os.path.normcase(os.path.abspath(filepath)), str(crs), str(source_crs), sorted(read_kwargs.items())]
+    digest = hashlib.sha1(json.dumps(options, default=option_repr).encode()).hexdigest()[:16]
+
+    name = os.path.splitext(os.path.basename(filepath))[0]
+    return os.path.join(cache_folder, f"{name}-{digest}.parquet")
+
+
+def read_vector(filepath, crs="EPSG:32631", source_crs=None, bbox=None, **read_kwargs):
+    """
+    Function reads a vector file through the GeoParquet cache.
+
+    Parameters
+    ----------
+    filepath : string
+        Filepath of the vector file (e.g. a shapefile).
+    crs : string or int
+        Coordinate reference system the data is reprojected to. Defaults to EPSG:32631.
+    source_crs : string or int
+        Coordinate reference system of the vector file, for files without (or with a wrong) .prj file.
+        None uses the coordinate reference system stored in the file.
+    bbox : tuple
+        Optional (minx, miny, maxx, maxy) in crs. Only features intersecting the bounding box are read.
+    **read_kwargs :
+        Additional keyword arguments passed to gpd.read_file() when the cache is created, e.g. an attribute
+        filter as where="cat_gewasc = 'Grasland'". Every combination of options is cached separately.
+
+    Returns
+    -------
+    gdf : GeoDataFrame in crs.
+
+    """
+    parquet_fp = cache_filepath(filepath, crs, source_crs, read_kwargs)
+    fingerprint_fp = os.path.splitext(parquet_fp)[0] + ".json"
+    fingerprint = source_fingerprint(filepath)
+
+    cached_fingerprint = None
+    if os.path.exists(parquet_fp) and os.path.exists(fingerprint_fp):
+        with open(fingerprint_fp) as f:
+            cached_fingerprint = json.load(f)
+
+    if cached_fingerprint != fingerprint:
+        gdf = gpd.read_file(filepath, **read_kwargs)
+        if source_crs is not None:
+            gdf = gdf.set_crs(source_crs, allow_override=True)
+        gdf = gdf.to_crs(crs)
+
+        # Write to temporary files first, so concurrent stages never read an incomplete cache.
+        # The suffix is unique per process and thread, so concurrent writers never share a temporary file
+        os.makedirs(cache_folder, exist_ok=True)
+        tmp_suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        gdf.to_parquet(parquet_fp + tmp_suffix, write_covering_bbox=True)
+        with open(fingerprint_fp + tmp_suffix, 'w') as f:
+            json.dump(fingerprint, f)
+        os.replace(parquet_fp + tmp_suffix, parquet_fp)
+        os.replace(fingerprint_fp + tmp_suffix, fingerprint_fp)
+
+        # The data is already in memory, so it is filtered instead of read again from the cache
+        return gdf if bbox is None else bbox_filter(gdf, bbox)
+
+    return gpd.read_parquet(parquet_fp, bbox=bbox)
+
+
+def bbox_filter(gdf, bbox):
+    """
+    Select the features of which the bounding box intersects bbox, the same features (and index)
+    as gpd.read_parquet() returns for the bbox.
+    """
+    minx, miny, maxx, maxy = bbox
+    bounds = gdf.geometry.bounds
+    intersects = (bounds["minx"] <= maxx) & (bounds["maxx"] >= minx) & (bounds["miny"] <= maxy) & (bounds["maxy"] >= miny)
+    return gdf[intersects.values].reset_index(drop=True)
+
+
+def vector_loader(**kwargs):
+    """
+    Return a loader for get_dataset() (see shared_datasets.py) which reads vector files through the
+    cache, e.g. get_dataset(datasets, filepath, vector_loader(source_crs='EPSG:28992')).
+    """
+    return lambda filepath: read_vector(filepath, **kwargs)